@@ -0,0 +1,253 @@
+# benchmarks the reader, preprocessor and writer on a synthetic corpus, run it from the repo root: python benchmarks/bench.py
+# the times are only compared to a baseline from the same machine, either saved earlier with --save-baseline
+# or by running another git revision alongside with --against, absolute times don't carry over between machines so none are committed
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compiler.base as base
+import compiler.preprocessor as preprocessor
+import compiler.reader as reader
+import compiler.writer as writer
+import corpus
+
+parser = argparse.ArgumentParser(description='Benchmarks for the injecting compiler')
+parser.add_argument('--classes', type=int, default=3000, help="How many source classes to generate")
+parser.add_argument('--repeat', type=int, default=3, help="Runs of each benchmark, the fastest one counts")
+parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json'))
+parser.add_argument('--save-baseline', action="store_true", help="Write the results as the new baseline")
+parser.add_argument('--against', metavar='REV', help="Compare against this git revision instead of a saved baseline, like HEAD~1 or master")
+parser.add_argument('--rounds', type=int, default=3, help="With --against, how many times each side runs, they take turns so a noisy machine slows both")
+parser.add_argument('--threshold', type=float, default=1.25, help="How much slower than the baseline counts as a regression")
+parser.add_argument('--dir', help="Where to generate the corpus, defaults to a temp folder")
+
+
+# (content, definitions, expected output), checked before anything gets timed since a fast wrong answer isn't worth measuring
+preprocessor_cases = [
+    ('x=#bool((a||b)&&c);', {'a': 1, 'c': 1}, 'x=True;'),
+    ('x=#bool((a||b)&&c);', {'a': 1}, 'x=False;'),
+    ('x=#defined((a || b));', {'b': 0}, 'x=True;'),
+    ('x=#switch((a||b): 1, 2);', {'b': 1}, 'x= 1;'),
+    ('x=#switch((a||b): 1, 2);', {}, 'x= 2;'),
+    ('x=#var(a) #bool(a', {'a': 3}, 'x=3 #bool(a'),
+    ('#ifdef a // comment\nyes\n#else\nno\n#endif', {'a': 1}, '//#ifdef a // comment\nyes\n//#else\n//no\n//#endif'),
+    ('#ifdef b // comment\nyes\n#else\nno\n#endif', {'a': 1}, '//#ifdef b // comment\n//yes\n//#else\nno\n//#endif'),
+]
+
+
+def check_preprocessor() -> bool:
+    ok = True
+    for (content, definitions, expected) in preprocessor_cases:
+        for result in (preprocessor.preprocessor(content, definitions), preprocessor.preprocess_lines(content, definitions)):
+            if result != expected:
+                print('preprocessor gave '+repr(result)+' for '+repr(content)+' with '+repr(definitions)+', expected '+repr(expected))
+                ok = False
+    return ok
+
+
+def read(settings, cache=None, pool=None):
+    orig_files = {}
+    mods_files = []
+    injects = {}
+    graph = reader.ClassGraph()
+    definitions = settings['preproc_definitions']
+    for package in settings['packages']:
+        entries = base.FileIndex(settings['source_path']+package+'/*').entries()
+        reader.proc_files(entries, orig_files, 'source', None, preprocessor, definitions, cache, pool, graph)
+    for mod in settings['mods_paths']:
+        mods_files.append({})
+        entries = base.FileIndex(mod+'*').entries()
+        reader.proc_files(entries, mods_files[-1], mod, injects, preprocessor, definitions, cache, pool, graph)
+    return orig_files, mods_files, injects
+
+
+def before_write(orig_files, mods_files, injects):
+    writer.before_write(orig_files, injects)
+    for mod in mods_files:
+        writer.before_write(mod, injects)
+
+
+def write(settings, orig_files, mods_files, injects):
+    out_dir = settings['out_dir']
+    written = {}
+    manifest = writer.Manifest(out_dir)
+    for f in orig_files.values():
+        writer.write_file(out_dir, f, written, injects, manifest)
+    for mod in mods_files:
+        for f in mod.values():
+            writer.write_file(out_dir, f, written, injects, manifest)
+    return written, manifest
+
+
+def mod_contents(settings):
+    contents = []
+    for mod in settings['mods_paths']:
+        for entry in base.FileIndex(mod+'*').entries():
+            with open(entry.path, 'rb') as f:
+                contents.append((entry.path, f.read().decode('windows-1252').replace('\r\n', '\n')))
+    return contents
+
+
+def run_benchmarks(settings, repeat):
+    results = {}
+
+    def measure(name, func, setup=None):
+        best = None
+        for i in range(repeat):
+            state = setup() if setup else None
+            start = timer()
+            func(state)
+            elapsed = timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+        print('{:<24}{:>10.4f}s'.format(name, best), file=sys.__stdout__)
+
+    def fresh_read(state=None):
+        return read(settings)
+
+    def written_out(state=None):
+        write(settings, *prepared_read(settings, True))[1].save()
+        return prepared_read(settings)
+
+    def stale_out(state=None):
+        # the second build with half of the mod gone, so cleanup has something to remove
+        write(settings, *prepared_read(settings, True))[1].save()
+        orig_files, mods_files, injects = read(settings)
+        for mod in mods_files:
+            for key in list(mod.keys())[::2]:
+                del mod[key]
+        before_write(orig_files, mods_files, injects)
+        written, manifest = write(settings, orig_files, mods_files, injects)
+        return written, manifest
+
+    contents = mod_contents(settings)
+    definitions = list(corpus.profiles.values())
+
+    measure('proc_files', lambda s: read(settings))
+    measure('proc_files cached', lambda s: read(settings, s),
+        lambda: warm_cache(settings))
+    measure('preprocessor', lambda s: [preprocessor.preprocessor(c, definitions[0], path) for (path, c) in contents],
+        lambda: preprocessor.templates.clear())
+    measure('preprocessor profiles', lambda s: [preprocessor.preprocessor(c, d, path) for d in definitions for (path, c) in contents],
+        lambda: preprocessor.templates.clear())
+    measure('before_write', lambda s: before_write(*s), fresh_read)
+    measure('write_file', lambda s: write(settings, *s), lambda: prepared_read(settings, True))
+    measure('write_file unchanged', lambda s: write(settings, *s), written_out)
+    measure('cleanup', lambda s: writer.cleanup(settings['out_dir'], s[0], s[1]), stale_out)
+    measure('cleanup without manifest', lambda s: writer.cleanup(settings['out_dir'], s[0], None), stale_out)
+    return results
+
+
+def prepared_read(settings, clean=False):
+    if clean:
+        clean_out(settings)
+    orig_files, mods_files, injects = read(settings)
+    before_write(orig_files, mods_files, injects)
+    return orig_files, mods_files, injects
+
+
+def warm_cache(settings):
+    path = os.path.join(base.get_cache_dir(settings['out_dir']), 'bench_parse_cache.pickle')
+    cache = reader.ParseCache(path, settings['preproc_definitions'])
+    read(settings, cache)
+    cache.save()
+    return reader.ParseCache(path, settings['preproc_definitions'])
+
+
+def clean_out(settings):
+    out = settings['out_dir']
+    shutil.rmtree(out, ignore_errors=True)
+    os.makedirs(os.path.join(out, 'System'))
+
+
+def saved_times(script, cwd, path, args) -> dict:
+    subprocess.run([sys.executable, script, '--save-baseline', '--baseline', path, '--classes', str(args.classes), '--repeat', str(args.repeat)],
+        cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    with open(path) as f:
+        return json.load(f)['times']
+
+
+def against_revision(rev, args):
+    # the bench.py from rev runs in a temporary worktree, and this one runs in its own process too so neither side gets a warmer start
+    # they take turns, and each benchmark keeps its fastest time from any round
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {}
+    baseline = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = os.path.join(tmp, 'tree')
+        path = os.path.join(tmp, 'times.json')
+        subprocess.run(['git', 'worktree', 'add', '--detach', tree, rev], cwd=repo, check=True)
+        try:
+            sides = ((baseline, os.path.join('benchmarks', 'bench.py'), tree), (results, os.path.abspath(__file__), repo))
+            for i in range(args.rounds):
+                print('round '+str(i+1)+' of '+str(args.rounds))
+                for (times, script, cwd) in sides:
+                    for (name, elapsed) in saved_times(script, cwd, path, args).items():
+                        times[name] = min(elapsed, times.get(name, elapsed))
+        finally:
+            subprocess.run(['git', 'worktree', 'remove', '--force', tree], cwd=repo)
+    return results, baseline
+
+
+def compare(results, baseline, threshold) -> bool:
+    ok = True
+    print('\n{:<24}{:>10}{:>10}{:>8}'.format('benchmark', 'time', 'baseline', 'ratio'))
+    for (name, elapsed) in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        ratio = elapsed / expected
+        line = '{:<24}{:>9.4f}s{:>9.4f}s{:>8.2f}'.format(name, elapsed, expected, ratio)
+        if ratio > threshold:
+            line += base.WARNING+'  REGRESSION'+base.ENDCOLOR
+            ok = False
+        print(line)
+    return ok
+
+
+def main():
+    args = parser.parse_args()
+    if not check_preprocessor():
+        return 1
+    if args.against:
+        results, baseline = against_revision(args.against, args)
+        return 0 if compare(results, baseline, args.threshold) else 1
+    with contextlib.ExitStack() as stack:
+        root = args.dir or stack.enter_context(tempfile.TemporaryDirectory())
+        start = timer()
+        settings = corpus.make_corpus(root, args.classes)
+        print('generated the corpus in '+str(timer() - start)+' seconds')
+
+        base.set_loglevel(base.DebugLevels.SILENT)
+        # the reader and writer print a lot, the results go to sys.__stdout__
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = run_benchmarks(settings, args.repeat)
+
+    results = {k: round(v, 5) for (k, v) in results.items()}
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'classes': args.classes, 'times': results}, f, indent=4)
+        print('saved the baseline to '+args.baseline)
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print('no baseline at '+args.baseline+', run with --save-baseline or use --against')
+        return 0
+    if baseline['classes'] != args.classes:
+        print('the baseline was made with --classes '+str(baseline['classes'])+', so the times won\'t line up')
+    return 0 if compare(results, baseline['times'], args.threshold) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+# makes a deterministic tree of fake UnrealScript in the same layout as a Deus Ex install and a mod, so the benchmarks don't need the game
+# the source has a few very wide classes and some deep chains, the mod has long #ifdef/#elseif ladders, chains of injects,
+# several merges into the same class, and shims over the wide classes
+import os
+import random
+import shutil
+
+# the preproc_definitions of the profiles the benchmarks pretend to build
+profiles = {
+    'vanilla': {'vanilla': 1, 'singleplayer': 1, 'fixes': 1, 'balance': 1, 'injections': 1, 'prefix': '', 'package': 'BenchMod'},
+    'hx': {'hx': 1, 'multiplayer': 1, 'balance': 1, 'prefix': 'HX', 'package': 'BenchMod'},
+    'gmdx': {'gmdx': 1, 'singleplayer': 1, 'injections': 1, 'prefix': '', 'package': 'BenchMod'},
+}
+flags = ['vanilla', 'hx', 'gmdx', 'revision', 'vmd', 'singleplayer', 'multiplayer', 'fixes', 'balance', 'injections']
+
+
+def make_corpus(root, classes=3000, wide=4, inject_chain=8, merges=6, ladders=200, seed=1):
+    # returns the settings for a profile that builds it, the out_dir starts empty
+    rng = random.Random(seed)
+    shutil.rmtree(root, ignore_errors=True)
+    source = os.path.join(root, 'source', '')
+    mod = os.path.join(root, 'mod', '')
+    out = os.path.join(root, 'out', '')
+
+    write(source, 'Core', 'Object', 'class Object\n\tnative;\n')
+    write(source, 'Engine', 'Actor', class_body(rng, 'Actor', 'Object', 40))
+    names = ['Actor']
+    wide_names = []
+    for i in range(wide):
+        name = 'Wide'+str(i)
+        write(source, 'DeusEx', name, class_body(rng, name, 'Actor', 20))
+        names.append(name)
+        wide_names.append(name)
+    for i in range(classes):
+        name = 'Bench'+str(i)
+        if rng.random() < 0.5:
+            base = rng.choice(wide_names)
+        else:
+            # mostly recent classes, so there are some deep chains
+            base = names[max(0, len(names) - 1 - int(rng.expovariate(0.2)))]
+        write(source, 'DeusEx', name, class_body(rng, name, base, rng.randint(3, 25)))
+        names.append(name)
+
+    for i in range(ladders):
+        write(mod, 'BenchMod', 'Ladder'+str(i), ladder_body(rng, 'Ladder'+str(i)))
+    for i in range(20):
+        write(mod, 'BenchMod', 'Plain'+str(i), class_body(rng, 'Plain'+str(i), 'Actor', 10))
+
+    # chains of injects into the same class
+    for target in rng.sample(names[wide+1:], 20):
+        for j in range(inject_chain):
+            name = 'Inj'+target+'_'+str(j)
+            write(mod, 'DeusEx', name, 'class '+name+' injects '+target+';\n\n' + functions(rng, 3))
+    # several merges into one class
+    for target in rng.sample(names[wide+1:], 10):
+        for j in range(merges):
+            name = 'Mrg'+target+'_'+str(j)
+            write(mod, 'DeusEx', name, 'class '+name+' merges '+target+';\n\nvar int Merged'+str(j)+';\n\n' + functions(rng, 2, target=target))
+    # shims over the wide classes
+    for target in wide_names:
+        name = 'Shim'+target
+        write(mod, 'DeusEx', name, 'class '+name+' shims '+target+';\n\n' + functions(rng, 2))
+
+    os.makedirs(os.path.join(out, 'System'), exist_ok=True)
+    return {
+        'source_path': source,
+        'mods_paths': [mod],
+        'out_dir': out,
+        'packages': ['Core', 'Engine', 'DeusEx'],
+        'preproc_definitions': profiles['vanilla'],
+    }
+
+
+def write(folder, package, name, content):
+    path = os.path.join(folder, package, 'Classes')
+    os.makedirs(path, exist_ok=True)
+    # the vanilla source has windows line endings
+    with open(os.path.join(path, name+'.uc'), 'w', newline='\r\n', encoding='windows-1252') as f:
+        f.write(content)
+
+
+def class_body(rng, name, base, num_functions):
+    lines = ['//=============================================================================', '// '+name+'.', '//=============================================================================']
+    lines.append('class '+name+' extends '+base)
+    lines.append('\tabstract;\n')
+    for i in range(rng.randint(2, 12)):
+        lines.append('var '+rng.choice(['int', 'float', 'bool', 'name', 'string', 'Actor'])+' '+name+'Var'+str(i)+'; // "quoted" comment')
+    lines.append('')
+    lines.append(functions(rng, num_functions))
+    lines.append('defaultproperties\n{')
+    for i in range(rng.randint(1, 8)):
+        lines.append('\t'+name+'Var'+str(i)+'='+str(rng.randint(0, 100)))
+    lines.append('}\n')
+    return '\n'.join(lines)
+
+
+def functions(rng, num, target=None):
+    out = []
+    for i in range(num):
+        fname = 'Func'+str(rng.randint(0, 40))
+        out.append(rng.choice(['function', 'simulated function', 'event', 'static function'])+' '+fname+'(int a, optional float b)')
+        out.append('{\n\tlocal int i;')
+        for j in range(rng.randint(2, 15)):
+            out.append(rng.choice([
+                '\tfor(i=0; i<a; i++) { b += i; } // the self in comments isn\'t code',
+                '\tif( Self.bHidden ) return;',
+                '\tlog("http://example.com/" $ self $ \' \' $ a);',
+                '\t/* block\n\t   comment */ a = a * 2;',
+                '\tSuper.'+fname+'(a, b);',
+                '\tSetTimer(0.5, true);',
+            ]))
+        if target:
+            out.append('\t_'+fname+'(a, b);')
+        out.append('}\n')
+    return '\n'.join(out)
+
+
+def ladder_body(rng, name):
+    lines = ['class '+name+' extends Actor config(#var(package));', '']
+    if rng.random() < 0.1:
+        lines.append('#compileif '+rng.choice(['vanilla', 'hx', 'vanilla || gmdx']))
+    for i in range(rng.randint(2, 6)):
+        lines.append('#ifdef '+condition(rng))
+        lines.append('var int '+name+'First'+str(i)+';')
+        for j in range(rng.randint(3, 18)):
+            lines.append(rng.choice(['#elseif ', '#elseifn '])+condition(rng))
+            lines.append('var int '+name+'Ladder'+str(i)+'_'+str(j)+';')
+            if rng.random() < 0.2:
+                lines.append('#ifndef '+rng.choice(flags))
+                lines.append('var int '+name+'Nested'+str(i)+'_'+str(j)+';')
+                lines.append('#endif')
+        lines.append('#else')
+        lines.append('var int '+name+'Else'+str(i)+';')
+        lines.append('#endif')
+        lines.append('')
+    lines.append(functions(rng, rng.randint(1, 6)))
+    lines.append('function string Describe()\n{\n\treturn "#var(prefix)" $ #bool(vanilla) $ #defined(hx) $ #switch(hx: 1, gmdx: 2, 3) $ #0b(101) $ #bit(0,3);\n}\n')
+    lines.append('#ifdef '+condition(rng)+' // a comment after the condition')
+    lines.append('function bool Nested()\n{\n\treturn #bool((vanilla || hx) && balance) || #defined((gmdx || vmd)) || #switch((hx || gmdx): true, false);\n}')
+    lines.append('#endif\n')
+    return '\n'.join(lines)
+
+
+def condition(rng):
+    r = rng.random()
+    if r < 0.5:
+        return rng.choice(flags)
+    if r < 0.75:
+        return rng.choice(flags)+' && !'+rng.choice(flags)
+    return '('+rng.choice(flags)+' || '+rng.choice(flags)+') && '+rng.choice(flags)
@@ -16,60 +16,111 @@ from timeit import default_timer as timer
 from importlib import reload, invalidate_caches
 
 import compiler.base
+import compiler.lexer
+import compiler.timing
 import compiler.preprocessor
 import compiler.reader
 import compiler.writer
 import compiler.tester
 import compiler.compiler
+import compiler.watcher
+import compiler.daemon
 
 parser = argparse.ArgumentParser(description='Deus Ex Injecting Compiler')
 
 parser.add_argument('--profile', help='Which profile(s) to use from the settings file')
 parser.add_argument('--verbose', action="store_true", help="Output way more to the screen")
 parser.add_argument('--once', action="store_true", help="Only run once and exit")
-args = parser.parse_args()
-#pp.pprint(args)
-print(repr(args))
+parser.add_argument('--watch', action="store_true", help="Recompile whenever the source or mod files change")
+parser.add_argument('--debounce', type=float, default=0.5, help="Seconds to wait for more changes before recompiling in --watch mode")
+parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds between checks in --watch mode when inotify isn't available")
+parser.add_argument('--jobs', type=int, default=1, help="How many profiles to build at the same time, for --profile all")
+parser.add_argument('--force-tests', action="store_true", help="Run the automated tests even when the compiled packages haven't changed since the last run")
+parser.add_argument('--daemon', action="store_true", help="Stay running and compile whenever a --client asks, keeping the parsed files in memory")
+parser.add_argument('--client', action="store_true", help="Ask the running --daemon to compile --profile, prints the result as json")
+parser.add_argument('--stop-daemon', action="store_true", help="Tell the running --daemon to exit")
+parser.add_argument('--address', help="Unix socket path or named pipe for --daemon and --client, defaults to one per working directory")
 
-if args.profile is None:
-    args.profile = input("type in a profile name to compile, or just press enter for all: ")
-    if args.profile == '':
-        args.profile = 'all'
 
-rerun = ""
-while rerun != "exit":
+def main():
+    args = parser.parse_args()
+    if args.client or args.stop_daemon:
+        # only the json goes to stdout so editors can parse it
+        sys.exit(client(args))
+
+    #pp.pprint(args)
+    print(repr(args))
+
+    if args.profile is None and not args.daemon:
+        args.profile = input("type in a profile name to compile, or just press enter for all: ")
+        if args.profile == '':
+            args.profile = 'all'
+
+    rerun = ""
+    while rerun != "exit":
+        try:
+            print("")
+            print("loading modules...")
+            invalidate_caches()
+            args.base = reload(compiler.base)
+            args.lexer = reload(compiler.lexer)
+            args.timing = reload(compiler.timing)
+            args.compiler = reload(compiler.compiler)
+            args.reader = reload(compiler.reader)
+            args.writer = reload(compiler.writer)
+            args.tester = reload(compiler.tester)
+            args.preprocessor = reload(compiler.preprocessor)
+            args.watcher = reload(compiler.watcher)
+            args.daemon_module = reload(compiler.daemon)
+
+            if args.watch:
+                # runs until ctrl+c, doesn't reload the modules again so it can keep its caches in memory
+                args.compiler.watch(args)
+                break
+            if args.daemon:
+                # same as --watch, the modules aren't reloaded so the parse caches stay warm between requests
+                args.daemon_module.serve(args, args.address)
+                break
+
+            if rerun != "":
+                args.profile = rerun
+
+            print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ": compiling "+args.profile+"...")
+            args.compiler.run(args)
+
+        except Exception as e:
+            args.base.printError('\n\ncompile error: ')
+            if args.verbose:
+                tb = traceback.TracebackException.from_exception(e, capture_locals=True)
+                print("\n----------\n".join(tb.format()))
+            else:
+                print(traceback.format_exc())
+            args.base.printError("----------------")
+
+        print("\n")
+        if args.once:
+            break
+        print( datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            + ": \npress enter to compile "+args.profile+" again")
+        print("- or type in a new profile name")
+        rerun = input("- otherwise type exit: ")
+
+    if not args.daemon and not args.watch:
+        input("press enter to continue")
+
+
+def client(args) -> int:
     try:
-        print("")
-        print("loading modules...")
-        invalidate_caches()
-        args.base = reload(compiler.base)
-        args.compiler = reload(compiler.compiler)
-        args.reader = reload(compiler.reader)
-        args.writer = reload(compiler.writer)
-        args.tester = reload(compiler.tester)
-        args.preprocessor = reload(compiler.preprocessor)
-
-        if rerun != "":
-            args.profile = rerun
-
-        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ": compiling "+args.profile+"...")
-        args.compiler.run(args)
-
-    except Exception as e:
-        args.base.printError('\n\ncompile error: ')
-        if args.verbose:
-            tb = traceback.TracebackException.from_exception(e, capture_locals=True)
-            print("\n----------\n".join(tb.format()))
+        if args.stop_daemon:
+            response = compiler.daemon.request({'command': 'stop'}, args.address)
         else:
-            print(traceback.format_exc())
-        args.base.printError("----------------")
-
-    print("\n")
-    if args.once:
-        break
-    print( datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        + ": \npress enter to compile "+args.profile+" again")
-    print("- or type in a new profile name")
-    rerun = input("- otherwise type exit: ")
-
-input("press enter to continue")
+            response = compiler.daemon.request_build(args.profile, args.address)
+    except OSError as e:
+        response = {'success': False, 'error': 'could not reach the daemon, is it running? '+repr(e)}
+    print(json.dumps(response, indent=4))
+    return 0 if response.get('success') else 1
+
+
+# the reader starts worker processes, which import this file again on Windows
+if __name__ == '__main__':
+    main()
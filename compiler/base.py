@@ -9,6 +9,11 @@ import shutil
 import traceback
 from pathlib import Path
 import time
+import errno
+import threading
+import tempfile
+import collections
+from contextlib import contextmanager
 from timeit import default_timer as timer
 from enum import Enum, IntEnum
 
@@ -25,7 +30,28 @@ vanilla_inheritance_keywords = [None, 'extends', 'expands']
 # text colors
 WARNING = '\033[91m'
 ENDCOLOR = '\033[0m'
-re_error = re.compile(r'((none)|(null)|(warning)|(error[^i])|(fail)|(critical)|(out of bounds)|((^| )time:)|(LoadMap:))', re.IGNORECASE)
+# the lines in a call's output that count as warnings, as (name, lowercase keyword, regex or None)
+# the keyword is checked first because a substring search is much faster than the regex on every line of UCC's output
+warning_rules = [
+    ('none', 'none', None),
+    ('null', 'null', None),
+    ('warning', 'warning', None),
+    ('error', 'error', re.compile(r'error[^i]', re.IGNORECASE)),
+    ('fail', 'fail', None),
+    ('critical', 'critical', None),
+    ('bounds', 'out of bounds', None),
+    ('time', 'time:', re.compile(r'(?:^| )time:', re.IGNORECASE)),
+    ('loadmap', 'loadmap:', None),
+]
+# for coloring the lines that matched
+re_error = re.compile('|'.join(regex.pattern if regex else re.escape(keyword) for (name, keyword, regex) in warning_rules), re.IGNORECASE)
+
+def classify_warning(line):
+    low = line.lower()
+    for (name, keyword, regex) in warning_rules:
+        if keyword in low and (regex is None or regex.search(line)):
+            return name
+    return None
 
 def set_loglevel(new_loglevel):
     global _loglevel
@@ -82,30 +108,133 @@ def printHeader(text):
 
 
 def print_colored(msg):
-    msg = re_error.sub(WARNING+"\\1"+ENDCOLOR, msg)
+    msg = re_error.sub(WARNING+"\\g<0>"+ENDCOLOR, msg)
     print(msg)
 
-def indent(msg):
-    return '\t'+msg.replace('\n', '\n\t')
+class PrefixedOutput():
+    # stands in for sys.stdout while profiles build in threads, each thread's lines get its own prefix
+    # and only whole lines get written so the profiles don't interleave in the middle of a line
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, s):
+        prefix = getattr(self.local, 'prefix', None)
+        if prefix is None:
+            with self.lock:
+                return self.stream.write(s)
+        lines = (self.local.buffer + s).split('\n')
+        self.local.buffer = lines.pop()
+        if lines:
+            with self.lock:
+                self.stream.write(''.join(prefix + line + '\n' for line in lines))
+        return len(s)
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextmanager
+def output_prefix(prefix):
+    # the caller swaps in the PrefixedOutput and puts the real stdout back once its threads are done
+    out = sys.stdout
+    if not isinstance(out, PrefixedOutput):
+        yield
+        return
+    out.local.prefix = prefix
+    out.local.buffer = ''
+    try:
+        yield
+    finally:
+        rest = out.local.buffer
+        out.local.prefix = None
+        if rest:
+            out.write(prefix + rest + '\n')
 
-def read(pipe, outs, errs, verbose):
-    o = ''
-    if pipe and pipe.readable():
-        o += pipe.readline()
 
-    hasWarnings = re_error.search(o)
-    if o and (verbose or hasWarnings):
-        print_colored(str(datetime.datetime.now().time()) +" "+ o.strip())
-    if hasWarnings:
-        errs += o
-    return outs+o, errs
+def get_output_prefix():
+    # for handing this thread's prefix to a thread it starts, threading.local doesn't carry over
+    out = sys.stdout
+    if not isinstance(out, PrefixedOutput):
+        return None
+    return getattr(out.local, 'prefix', None)
 
 
-def call(cmds, verbose=False, stdout=True, stderr=True):
+def indent(msg):
+    return '\t'+msg.replace('\n', '\n\t')
+
+class CallOutput():
+    # collects the output for call(), in a temp file once it gets past spill_size characters
+    # warnings get printed and go into errs, a line that repeats is only printed and kept once
+    # on_line gets every line as it comes in, if it returns True then the process gets killed and call() returns normally
+    # with tail only the last lines get read back from the temp file, otherwise a big log would be back in memory all at once
+    def __init__(self, verbose, spill_size=16*1024*1024, on_line=None, proc=None):
+        self.verbose = verbose
+        self.on_line = on_line
+        self.proc = proc
+        self.stopped = False
+        self.outs = tempfile.SpooledTemporaryFile(max_size=spill_size, mode='w+', encoding='utf-8', errors='replace', newline='')
+        self.errs = []
+        self.repeats = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.finished = False
+
+    def read_pipe(self, pipe, prefix=None):
+        # the warnings get printed from this thread, so it needs the prefix of the thread that called call()
+        with output_prefix(prefix):
+            for line in pipe:
+                self.add(line)
+
+    def add(self, line):
+        with self.lock:
+            if self.finished:
+                return
+            self.outs.write(line)
+            if self.on_line and not self.stopped and self.on_line(line):
+                self.stopped = True
+                self.proc.kill()
+            if self.verbose:
+                print_colored(str(datetime.datetime.now().time()) +" "+ line.strip())
+            if line in self.repeats:
+                self.repeats[line] += 1
+                return
+            kind = classify_warning(line)
+            if not kind:
+                return
+            self.repeats[line] = 0
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+            self.errs.append(line)
+            if not self.verbose:
+                print_colored(str(datetime.datetime.now().time()) +" "+ line.strip())
+
+    def finish(self, tail=None):
+        with self.lock:
+            self.finished = True
+            self.outs.seek(0)
+            if tail is None:
+                outs = self.outs.read()
+            else:
+                outs = ''.join(collections.deque(self.outs, maxlen=tail))
+            self.outs.close()
+        repeated = sum(self.repeats.values())
+        if repeated:
+            info(str(repeated)+" repeated warning lines were hidden")
+        if self.counts:
+            info(str(len(self.errs))+" warnings: "+', '.join(k+' '+str(v) for (k, v) in sorted(self.counts.items())))
+        return outs, ''.join(self.errs)
+
+
+def call(cmds, verbose=False, stdout=True, stderr=True, timeout=600, on_line=None, tail=None):
+    # timeout is in seconds, None waits forever, on_line and tail are explained in CallOutput
     global _loglevel
     print("\nrunning "+repr(cmds))
     start = timer()
-    last_print = start
     if _loglevel >= DebugLevels.TRACE:
         verbose = True
 
@@ -121,37 +250,104 @@ def call(cmds, verbose=False, stdout=True, stderr=True):
         stdout = None
 
     proc = subprocess.Popen(cmds, stdout=stdout, stderr=stderr, close_fds=True, universal_newlines=True, errors="replace")
-    outs = ''
-    errs = ''
     pipe = None
     if stdout:
         pipe = proc.stdout
     elif stderr:
         pipe = proc.stderr
 
+    # the pipe gets read in a thread, so this one can just wait on the process with a timeout instead of polling
+    output = CallOutput(verbose, on_line=on_line, proc=proc)
+    reader = None
+    if pipe:
+        reader = threading.Thread(target=output.read_pipe, args=(pipe, get_output_prefix()), daemon=True)
+        reader.start()
+
+    timed_out = False
     try:
-        while proc.returncode is None and timer() - start < 600:
-            (outs, errs) = read(pipe, outs, errs, verbose)
-            proc.poll()
-        if proc.returncode != 0:
-            raise Exception("call didn't return 0: "+repr(cmds), outs, errs)
-    except Exception as e:
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        proc.kill()
+        proc.wait()
+    except BaseException:
         proc.kill()
-        (outs, errs) = read(pipe, outs, errs, verbose)
-        proc.poll()
-        #print(traceback.format_exc())
         raise
+    finally:
+        if reader:
+            # something else could still have the pipe open, like the wineserver
+            reader.join(5)
+
+    (outs, errs) = output.finish(tail)
+    if timed_out:
+        raise Exception("call timed out after "+str(timeout)+" seconds: "+repr(cmds), outs, errs)
+    if output.stopped:
+        print( repr(cmds) + " was stopped early after " + str(timer() - start) + " seconds\n" )
+        return (proc.returncode, outs, errs)
+    if proc.returncode != 0:
+        raise Exception("call didn't return 0: "+repr(cmds), outs, errs)
     elapsed_time = timer() - start # in seconds
     print( repr(cmds) + " took " + str(elapsed_time) + " seconds and returned " + str(proc.returncode) + "\n" )
     return (proc.returncode, outs, errs)
 
 
-def insensitive_glob(pattern):
-    return sorted(
-        glob.glob(pattern, recursive=True)
-        + glob.glob(pattern+'/**', recursive=True)
-        + glob.glob(pattern+'/*', recursive=True)
-    )
+class IndexEntry():
+    __slots__ = ('path', 'size', 'mtime_ns', 'uc')
+
+    def __init__(self, path, st):
+        self.path = path
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.uc = is_uc_file(path) # False, or the parsed (success, filename, namespace, parent, type)
+
+
+class FileIndex():
+    # replaces insensitive_glob, walks each folder once with os.scandir and keeps the stat results and path parts of every file
+    # like glob, hidden files and folders are skipped and the paths are joined the same way so they sort the same
+    def __init__(self, *patterns):
+        self.patterns = patterns
+        self.files = {} # normalized path -> IndexEntry
+        self.dirs = set() # normalized paths
+        for pattern in patterns:
+            for root in glob.glob(pattern):
+                if os.path.isdir(root):
+                    self._walk(root)
+                elif os.path.isfile(root):
+                    self._add(root, os.stat(root))
+
+    def _walk(self, folder):
+        self.dirs.add(str(Path(folder)))
+        with os.scandir(folder) as it:
+            for e in it:
+                if e.name.startswith('.'):
+                    continue
+                path = os.path.join(folder, e.name)
+                if e.is_dir():
+                    self._walk(path)
+                elif e.is_file():
+                    self._add(path, e.stat())
+
+    def _add(self, path, st):
+        self.files[str(Path(path))] = IndexEntry(path, st)
+
+    def entries(self) -> list:
+        return sorted(self.files.values(), key=lambda e: e.path)
+
+    def get(self, path):
+        return self.files.get(str(Path(path)))
+
+    def has_dir(self, path) -> bool:
+        return str(Path(path)) in self.dirs
+
+
+file_indexes = {}
+
+def get_file_index(pattern) -> FileIndex:
+    # shared for the rest of this run (modules get reloaded for every run), so profiles with the same mods_paths only walk it once
+    global file_indexes
+    if pattern not in file_indexes:
+        file_indexes[pattern] = FileIndex(pattern)
+    return file_indexes[pattern]
 
 
 def exists(file):
@@ -160,12 +356,37 @@ def exists(file):
     #     print("file already exists: " + file)
     return exists
 
+def copy_file(src, dst):
+    # the bytes don't go through python, and on filesystems with reflinks copy_file_range can share the blocks instead of copying them
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                raise
+    # uses sendfile on linux and fcopyfile on mac
+    shutil.copyfile(src, dst)
+
 def exists_dir(path):
     exists = os.path.isdir(path)
     # if exists:
     #     print("dir already exists: " + path)
     return exists
 
+def get_cache_dir(out_dir):
+    # our own bookkeeping files live in a hidden folder inside the out_dir, so each profile gets its own
+    path = os.path.join(out_dir, '.injector')
+    os.makedirs(path, exist_ok=True)
+    return path
+
 def find_type_dir_path_offset(path):
     typeDirs = ["Classes","Textures","Sounds","Text"]
 
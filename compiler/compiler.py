@@ -2,6 +2,9 @@
 import hashlib
 from compiler.base import *
 import json
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from compiler.timing import Timings, recording, span, current
 
 dryrun = False
 
@@ -15,11 +18,7 @@ def merge_dicts(base, priority):
     return merged
 
 
-def run(args):
-    if args.verbose:
-        args.base.loglevel = 'debug'
-
-    argprofiles = args.profile
+def load_settings():
     default_settings = {}
     with open('compiler_settings.default.json') as f:
         default_settings = json.load(f)
@@ -32,33 +31,172 @@ def run(args):
         appendException(e, '\n\nERROR: You need to copy compiler_settings.example.json to compiler_settings.json and adjust the paths.')
         raise
 
-    merged = merge_dicts(default_settings, settings)
+    return merge_dicts(default_settings, settings), settings
 
+
+def get_profiles(args):
+    # returns a list of (profile_name, profile)
+    merged, settings = load_settings()
+    argprofiles = args.profile
     profiles = []
     if argprofiles == 'all':
         profiles = settings.keys()
     else:
         profiles = argprofiles.split(',')
 
-    for p in profiles:
-        profile_name = p.strip()
-        profile = merged[profile_name]
+    return [(p.strip(), merged[p.strip()]) for p in profiles]
+
+
+def run(args) -> list:
+    # returns a result dict for each profile that ran, see run_profile
+    if args.verbose:
+        args.base.loglevel = 'debug'
+
+    profiles = get_profiles(args)
+    for (profile_name, profile) in profiles:
         assert(profile['source_path'])
         assert(profile['out_dir'])
         assert(profile['source_path'] != profile['out_dir'])
         assert(profile['source_path'].endswith('/') or profile['source_path'].endswith('\\'))
         assert(profile['out_dir'].endswith('/') or profile['out_dir'].endswith('\\'))
-        if profile['verbose']:
-            increase_loglevel(DebugLevels.DEBUG)
-        else:
-            increase_loglevel(DebugLevels.INFO)
-        printHeader("using profile: "+profile_name+", settings:")
-        notice(repr(profile)+"\n")
-        if not run_profile(args, profile):
-            return
+
+    jobs = getattr(args, 'jobs', None) or 1
+    if jobs > 1 and len(profiles) > 1:
+        out_dirs = [os.path.abspath(profile['out_dir']) for (profile_name, profile) in profiles]
+        if len(set(out_dirs)) == len(out_dirs):
+            return run_concurrent(args, profiles, jobs)
+        notice("profiles share an out_dir, building them one at a time")
+
+    results = []
+    for (profile_name, profile) in profiles:
+        result = run_one(args, profile_name, profile)
+        results.append(result)
+        if not result['success']:
+            break
+    return results
 
 
-def run_profile(args, settings):
+def run_one(args, profile_name, profile) -> dict:
+    if profile['verbose']:
+        increase_loglevel(DebugLevels.DEBUG)
+    else:
+        increase_loglevel(DebugLevels.INFO)
+    printHeader("using profile: "+profile_name+", settings:")
+    notice(repr(profile)+"\n")
+    timings = Timings(profile_name)
+    try:
+        with recording(timings):
+            result = run_profile(args, profile)
+    finally:
+        trace = os.path.join(get_cache_dir(profile['out_dir']), 'trace.json')
+        timings.save(trace)
+    timings.print_summary(profile.get('timing_top', 5))
+    info("saved the timing trace to "+trace)
+    result['profile'] = profile_name
+    result['timings'] = timings.totals(top_level=True)
+    return result
+
+
+def run_concurrent(args, profiles, jobs) -> list:
+    # each profile has its own out_dir and most of the time is spent waiting on ucc, so threads are enough
+    # a failed profile doesn't stop the others, the summary at the end shows all of them
+    workers = min(jobs, len(profiles))
+    readers = max(1, (os.cpu_count() or 1) // workers)
+    # forking the reader processes while another profile's thread holds the stdout or logging locks would leave them with a lock nobody releases
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    start = timer()
+
+    def build(profile_name, profile):
+        if not profile.get('jobs'):
+            # split the reader processes between the profiles instead of each one starting cpu_count of them
+            profile = dict(profile, jobs=readers)
+        if not profile.get('start_method'):
+            profile = dict(profile, start_method=start_method)
+        with output_prefix('['+profile_name+'] '):
+            try:
+                return run_one(args, profile_name, profile)
+            except Exception as e:
+                printError('compile error: ')
+                print(traceback.format_exc())
+                return {'success': False, 'warnings': [], 'timings': {}, 'profile': profile_name, 'error': repr(e)}
+
+    stdout = sys.stdout
+    sys.stdout = PrefixedOutput(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(build, profile_name, profile) for (profile_name, profile) in profiles]
+            results = [f.result() for f in futures]
+    finally:
+        sys.stdout = stdout
+
+    print_summary(results, timer() - start)
+    return results
+
+
+def print_summary(results, elapsed):
+    printHeader("summary of "+str(len(results))+" profiles")
+    for result in results:
+        status = 'ok' if result['success'] else WARNING+'FAILED'+ENDCOLOR
+        timings = ', '.join(k+' '+'%.1f' % v+'s' for (k, v) in result['timings'].items())
+        line = result['profile'] + ': ' + status + ', ' + str(len(result['warnings'])) + ' warnings'
+        if timings:
+            line += ', ' + timings
+        if result.get('error'):
+            line += ', ' + result['error']
+        print(line)
+    notice("all profiles took "+str(elapsed)+" seconds")
+
+
+def watch(args):
+    # --watch mode, the modules aren't reloaded between builds so the parse caches stay in memory
+    args.keep_caches = True
+    # only the changed files get read again, and the manifest skips the outputs that didn't change
+    paths = []
+    ignore = []
+    for (profile_name, profile) in get_profiles(args):
+        source = profile.get('source_path')
+        if source:
+            for package in profile['packages']:
+                paths += glob.glob(source+'/'+package)
+        for mod in profile['mods_paths']:
+            paths += glob.glob(mod+'*')
+        ignore.append(profile['out_dir'])
+        # copy_local puts the compiled packages in the working directory, which is usually one of the mods_paths
+        for package in profile['packages']:
+            ignore.append(package+'.u')
+    paths = sorted(set(str(Path(p)) for p in paths))
+    watcher = args.watcher.make_watcher(paths, ignore, args.poll_interval)
+
+    try:
+        run_watched(args)
+        while True:
+            notice(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ": waiting for changes to "+args.profile+"...")
+            changed = watcher.wait(args.debounce)
+            for file in sorted(changed)[:20]:
+                info("changed: "+file)
+            if len(changed) > 20:
+                info("and "+str(len(changed)-20)+" more")
+            # the folders need to be walked again, but the parse cache only reads the files whose stats changed
+            file_indexes.clear()
+            run_watched(args)
+    except KeyboardInterrupt:
+        notice("\nstopped watching")
+
+
+def run_watched(args):
+    try:
+        start = timer()
+        run(args)
+        notice("build took "+str(timer() - start)+" seconds")
+    except Exception as e:
+        printError('\n\ncompile error: ')
+        print(traceback.format_exc())
+        printError("----------------")
+
+
+def run_profile(args, settings) -> dict:
+    # the result is plain data so the daemon can send it as json, run_one fills in the timings
+    result = {'success': False, 'warnings': [], 'timings': {}}
     out = settings['out_dir']
     packages = settings['packages']
     run_tests = settings['run_tests']
@@ -75,30 +213,239 @@ def run_profile(args, settings):
         if gitstatus and re.search(r'%s' % settings.get('copy_if_changed'), gitstatus):
             changed = True
 
-    (compileResult, compileWarnings) = compile(args, settings)
-    if compileResult != 0:
-        return False
+    with span('compile'):
+        compiled = compile(args, settings)
+    if compiled.ret != 0:
+        return result
+    compileWarnings = compiled.warnings
+    result['warnings'] = list(compileWarnings)
 
     testSuccess = True
     if run_tests:
-        testSuccess = args.tester.runAutomatedTests(out, packages[0])
+        with span('tests'):
+            force = getattr(args, 'force_tests', False) or not settings.get('test_cache', True)
+            testSuccess = args.tester.runAutomatedTests(out, packages[0], settings.get('fail_fast', False), settings.get('ucc_timeout', 600), force)
         for warning in compileWarnings:
             print_colored(warning)
 
     if not testSuccess:
-        return False
+        return result
 
     if settings.get('copy_if_changed') and not changed:
         notice("not copying locally because "+settings.get('copy_if_changed')+" has not changed: "+repr(packages))
     elif copy_local:
-        copy_package_files(out, packages)
+        with span('copy'):
+            copy_package_files(out, packages)
     else:
         notice("not copying locally due to compiler_settings config file: "+repr(packages))
 
-    return True
+    result['success'] = True
+    return result
+
+
+def check_hashes(hash_checks, orig_files, snapshot=None):
+    for hashcheck in hash_checks:
+        c = hashcheck['class']
+        assert c in orig_files, 'File exists? '+c
+        expected = hashcheck['expected']
+        if snapshot and c in snapshot.verified:
+            continue
+        hash = MD5(orig_files[c].content)
+        assert hash == expected, 'MD5 of ' + c + ' is ' + hash + ', expected ' + expected
+        if snapshot:
+            snapshot.passed(c, expected, orig_files[c].file)
+
+
+class SourceSnapshot():
+    # the size, mtime and md5 of every file in the source packages, saved next to the source_path so the profiles that share a backup share it
+    # files only get hashed again when their stats change, and a hash_check that passed doesn't need to be redone until its file changes
+    def __init__(self, source, packages, definitions, hash_checks, version):
+        self.source = source
+        self.path = source.rstrip('/\\') + '.injector-snapshot.json'
+        self.packages = packages
+        # the checks are against the preprocessed content, so they're remembered per set of definitions and version of the reader code
+        self.definitions = hashlib.md5((version + json.dumps(definitions, sort_keys=True)).encode('utf-8')).hexdigest()[:12]
+        self.hash_checks = hash_checks
+        self.old = {}
+        self.files = {} # path relative to the source_path -> [size, mtime_ns, md5]
+        self.checks = {}
+        self.verified = set()
+        self.changed = []
+        self.removed = []
+        self.hashed = 0
+        self.thread = None
+        self.error = None
+
+    def start(self, orig_files, timings=None):
+        paths = {}
+        for hashcheck in self.hash_checks:
+            c = hashcheck['class']
+            if c in orig_files:
+                paths[c] = orig_files[c].file
+        self.thread = threading.Thread(target=self.run, args=(paths, timings), daemon=True)
+        self.thread.start()
 
+    def join(self):
+        self.thread.join()
+        if self.error:
+            raise self.error
 
-def compile(args, settings):
+    def run(self, paths, timings):
+        try:
+            with recording(timings), span('verify source'):
+                self.verify(paths)
+        except Exception as e:
+            self.error = e
+
+    def relpath(self, path) -> str:
+        return Path(os.path.relpath(path, self.source)).as_posix()
+
+    def verify(self, paths):
+        try:
+            with open(self.path) as f:
+                self.old = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            notice('ignoring unreadable source snapshot '+self.path+': '+repr(e))
+        old_files = self.old.get('files', {})
+
+        for package in self.packages:
+            for entry in get_file_index(self.source+'/'+package+'/*').entries():
+                rel = self.relpath(entry.path)
+                old = old_files.get(rel)
+                if old and old[0] == entry.size and old[1] == entry.mtime_ns:
+                    self.files[rel] = old
+                    continue
+                with open(entry.path, 'rb') as f:
+                    hash = hashlib.md5(f.read()).hexdigest()
+                self.hashed += 1
+                if old and old[2] != hash:
+                    self.changed.append(rel)
+                self.files[rel] = [entry.size, entry.mtime_ns, hash]
+
+        packages = set(self.packages)
+        for rel in old_files.keys() - self.files.keys():
+            if rel.split('/')[0] in packages:
+                self.removed.append(rel)
+            else:
+                # another profile's packages
+                self.files[rel] = old_files[rel]
+
+        old_checks = self.old.get('checks', {})
+        for hashcheck in self.hash_checks:
+            c = hashcheck['class']
+            file = self.files.get(self.relpath(paths[c])) if c in paths else None
+            if file and old_checks.get(c+' '+self.definitions) == [hashcheck['expected'], file[2]]:
+                self.verified.add(c)
+
+    def report(self):
+        info("source snapshot: hashed "+str(self.hashed)+" of "+str(len(self.files))+" files, "+str(len(self.verified))+" hash checks still verified")
+        if not self.old:
+            notice("no source snapshot yet, created "+self.path)
+        for (what, files) in (('changed', self.changed), ('removed', self.removed)):
+            if files:
+                printError(str(len(files))+" source files "+what+" since the last build: "+', '.join(sorted(files)[:10]) + (' ...' if len(files) > 10 else ''))
+
+    def passed(self, c, expected, path):
+        self.checks[c+' '+self.definitions] = [expected, self.files[self.relpath(path)][2]]
+
+    def save(self):
+        checks = dict(self.old.get('checks', {}))
+        checks.update(self.checks)
+        # unique temp name, profiles building at the same time can share a source_path
+        temp = self.path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        try:
+            with open(temp, 'w') as f:
+                json.dump({'files': self.files, 'checks': checks}, f, indent=0, sort_keys=True)
+            os.replace(temp, self.path)
+        except OSError as e:
+            notice("couldn't save the source snapshot "+self.path+": "+repr(e))
+
+
+class BuildFingerprint():
+    # what went into each package's .u at the last successful ucc make, so it can be skipped when none of that changed
+    # the outputs come from the manifest, plus UCC.exe, the ini files and the stats of the other packages it loads
+    def __init__(self, out_dir, packages):
+        self.path = os.path.join(get_cache_dir(out_dir), 'build.json')
+        self.out_dir = out_dir
+        self.packages = packages
+        self.fingerprints = {}
+        self.old = {}
+        try:
+            with open(self.path) as f:
+                self.old = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            notice('ignoring unreadable build fingerprint '+self.path+': '+repr(e))
+
+    def package_file(self, package) -> str:
+        return self.out_dir + '/System/'+package+'.u'
+
+    def tools(self, h):
+        system = Path(self.out_dir)/'System'
+        own = set(p.lower()+'.u' for p in self.packages)
+        for file in sorted(system.glob('*')):
+            name = file.name.lower()
+            # test.ini gets rewritten for every test run
+            if name == 'ucc.exe' or (name.endswith('.ini') and name != 'test.ini'):
+                with open(file, 'rb') as f:
+                    h.update((name+' '+hashlib.md5(f.read()).hexdigest()+'\n').encode('utf-8'))
+            elif name.endswith('.u') and name not in own:
+                st = file.stat()
+                h.update((name+' '+str(st.st_size)+' '+str(st.st_mtime_ns)+'\n').encode('utf-8'))
+
+    def compute(self, manifest):
+        outputs = {}
+        for (rel, entry) in manifest.new.items():
+            outputs.setdefault(rel.split('/')[0].lower(), []).append(rel+' '+entry[0]+'\n')
+        h = hashlib.md5()
+        self.tools(h)
+        # each fingerprint includes the packages before it, one of them changing means the later ones get rebuilt against it
+        for package in self.packages:
+            h.update(('package '+package+'\n').encode('utf-8'))
+            for line in sorted(outputs.get(package.lower(), [])):
+                h.update(line.encode('utf-8'))
+            self.fingerprints[package] = h.hexdigest()
+
+    def stale(self, manifest) -> list:
+        # the packages that need ucc make, everything from the first one that changed
+        self.compute(manifest)
+        old = self.old.get('packages', {})
+        for (i, package) in enumerate(self.packages):
+            entry = old.get(package)
+            try:
+                st = os.stat(self.package_file(package))
+            except FileNotFoundError:
+                return self.packages[i:]
+            if entry != [self.fingerprints[package], st.st_size, st.st_mtime_ns]:
+                return self.packages[i:]
+        return []
+
+    def warnings(self) -> list:
+        return self.old.get('warnings', [])
+
+    def save(self, warnings):
+        packages = {}
+        for package in self.packages:
+            st = os.stat(self.package_file(package))
+            packages[package] = [self.fingerprints[package], st.st_size, st.st_mtime_ns]
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'packages': packages, 'warnings': warnings}, f, indent=0, sort_keys=True)
+        os.replace(temp, self.path)
+
+
+class CompileResult():
+    # classgraph lets tools like unreal-map-flipper query the class hierarchy without running the reader again
+    def __init__(self, ret, warnings=None, classgraph=None):
+        self.ret = ret
+        self.warnings = warnings
+        self.classgraph = classgraph
+
+
+def compile(args, settings) -> CompileResult:
     orig_files = {}
     mods_files = []
     injects = {}
@@ -119,74 +466,133 @@ def compile(args, settings):
     preprocessor = args.preprocessor
     writer = args.writer
 
-    if source:
-        notice("processing source files from "+source)
-        for package in packages:
-            for file in insensitive_glob(source+'/'+package+'/*'):
+    cache = None
+    if settings.get('parse_cache', True):
+        cache = reader.get_parse_cache(os.path.join(get_cache_dir(out_dir), 'parse_cache.pickle'), definitions)
+
+    graph = reader.ClassGraph()
+    snapshot = None
+    jobs = settings.get('jobs') or os.cpu_count() or 1
+    pool = reader.ReadPool(jobs, settings.get('start_method'))
+    try:
+        if source:
+            notice("processing source files from "+source)
+            for package in packages:
+                files = get_file_index(source+'/'+package+'/*').entries()
                 try:
-                    reader.proc_file(file, orig_files, 'source', None, preprocessor, definitions)
+                    with span('read source'):
+                        reader.proc_files(files, orig_files, 'source', None, preprocessor, definitions, cache, pool, graph)
                 except Exception as e:
-                    appendException(e, "error processing vanilla file: "+file)
+                    appendException(e, "error processing vanilla files from: "+package)
                     raise
-        for hashcheck in settings.get('hash_checks', []):
-            c = hashcheck['class']
-            assert c in orig_files, 'File exists? '+c
-            hash = MD5(orig_files[c].content)
-            expected = hashcheck['expected']
-            assert hash == expected, 'MD5 of ' + c + ' is ' + hash + ', expected ' + expected
-        # helps with unreal-map-flipper
-        # a = reader.GetSubclasses('Decoration')
-        # for c in a:
-        #     print(c+'=0,')
-        # sys.exit(0)
-
-    for mod in mods:
-        notice("processing files from mod "+mod)
-        mods_files.append({})
-        for file in insensitive_glob(mod+'*'):
+            if settings.get('source_snapshot', True):
+                # verified on a thread while the mods are read
+                snapshot = SourceSnapshot(source, packages, definitions, settings.get('hash_checks', []), reader.cache_version())
+                snapshot.start(orig_files, current())
+            else:
+                with span('hash checks'):
+                    check_hashes(settings.get('hash_checks', []), orig_files)
+            # helps with unreal-map-flipper
+            # a = graph.get_descendants('Decoration')
+            # for c in a:
+            #     print(c+'=0,')
+            # sys.exit(0)
+
+        for mod in mods:
+            notice("processing files from mod "+mod)
+            mods_files.append({})
+            files = [e for e in get_file_index(mod+'*').entries() if not file_is_blacklisted(e.path, settings)]
             try:
-                if file_is_blacklisted(file, settings):
-                    continue
-                f = reader.proc_file(file, mods_files[-1], mod, injects, preprocessor, definitions)
-                if f and f.namespace in rewrite_packages:
-                    f.namespace = rewrite_packages[f.namespace]
+                with span('read mods'):
+                    for f in reader.proc_files(files, mods_files[-1], mod, injects, preprocessor, definitions, cache, pool, graph):
+                        if f.namespace in rewrite_packages:
+                            f.namespace = rewrite_packages[f.namespace]
             except Exception as e:
-                appendException(e, "error processing mod file: "+file)
+                appendException(e, "error processing mod files from: "+mod)
                 raise
-        assert len(mods_files[-1]) > 0, 'found code files in '+mod
+            assert len(mods_files[-1]) > 0, 'found code files in '+mod
+    finally:
+        pool.shutdown()
+
+    if snapshot:
+        with span('hash checks'):
+            snapshot.join()
+            snapshot.report()
+            check_hashes(settings.get('hash_checks', []), orig_files, snapshot)
+            snapshot.save()
+
+    if cache:
+        info("parse cache: "+str(cache.hits)+" hits, "+str(cache.misses)+" misses")
+        with span('save parse cache'):
+            cache.save()
+        if not getattr(args, 'keep_caches', False):
+            cache.release()
+
+    # only index the package folders we write to, not the whole install, and the out_dir changes between builds so this one doesn't get shared
+    namespaces = set(f.namespace for f in orig_files.values())
+    for mod in mods_files:
+        namespaces.update(f.namespace for f in mod.values())
+    with span('index out_dir'):
+        out_index = FileIndex(*[out_dir+ns for ns in sorted(namespaces)])
+        manifest = writer.Manifest(out_dir, out_index)
 
-    notice("\nwriting source files...")
-    writer.before_write(orig_files, injects)
-    for file in orig_files.values():
-        try:
-            debug("Writing file "+str(file.file))
-            writer.write_file(out_dir, file, written, injects)
-        except Exception as e:
-            appendException(e, "error writing vanilla file "+str(file.file))
-            raise
+    try:
+        notice("\nwriting source files...")
+        with span('before_write'):
+            writer.before_write(orig_files, injects)
+        with span('write source'):
+            for file in orig_files.values():
+                try:
+                    debug("Writing file "+str(file.file))
+                    writer.write_file(out_dir, file, written, injects, manifest, out_index)
+                    if type(file).__name__ == 'UnrealScriptFile' and file.qualifiedclass not in injects:
+                        # nothing reads the text of an untouched vanilla class again, so peak memory doesn't grow with the source
+                        file.release()
+                        preprocessor.templates.pop(file.file, None)
+                except Exception as e:
+                    appendException(e, "error writing vanilla file "+str(file.file))
+                    raise
 
-    for mod in mods_files:
-        notice("writing mod "+repr(mod.keys())[:200])
-        try:
-            writer.before_write(mod, injects)
-        except Exception as e:
-            appendException(e, "error before_write mod "+repr(mod.keys()))
-            raise
-        for file in mod.values():
-            debug("Writing mod file "+str(file.file))
+        for mod in mods_files:
+            notice("writing mod "+repr(mod.keys())[:200])
             try:
-                writer.write_file(out_dir, file, written, injects)
+                with span('before_write'):
+                    writer.before_write(mod, injects)
             except Exception as e:
-                appendException(e, "error writing mod file "+str(file.file))
+                appendException(e, "error before_write mod "+repr(mod.keys()))
                 raise
+            with span('write mods'):
+                for file in mod.values():
+                    debug("Writing mod file "+str(file.file))
+                    try:
+                        writer.write_file(out_dir, file, written, injects, manifest, out_index)
+                    except Exception as e:
+                        appendException(e, "error writing mod file "+str(file.file))
+                        raise
+    except BaseException:
+        # keep the files from last time too, whatever this build already wrote still needs to be cleaned up later
+        manifest.save(keep_old=True)
+        raise
 
     if dryrun:
-        return 1
-
-    writer.cleanup(out_dir, written)
+        manifest.save(keep_old=True)
+        return CompileResult(1, None, graph)
+
+    with span('cleanup'):
+        writer.cleanup(out_dir, written, manifest)
+        manifest.save()
+
+    stale = packages
+    fingerprint = None
+    if settings.get('build_fingerprint', True):
+        fingerprint = BuildFingerprint(out_dir, packages)
+        stale = fingerprint.stale(manifest)
+        if not stale:
+            notice("up to date, skipping ucc make for "+repr(packages))
+            return CompileResult(0, fingerprint.warnings(), graph)
 
     # now we need to delete DeusEx.u otherwise it won't get recompiled, might want to consider support for other packages too
-    for package in packages:
+    for package in stale:
         file = out_dir + '/System/'+package+'.u'
         if exists(file):
             notice("Removing old "+file)
@@ -203,7 +609,8 @@ def compile(args, settings):
         cmd = [ str(ucc), 'make', '-h', '-NoBind', '-Silent' ]
         if os.name != 'nt':
             cmd = ['wine'] + cmd
-        (ret, out, errs) = call(cmd)
+        with span('ucc make'):
+            (ret, out, errs) = call(cmd, timeout=settings.get('ucc_timeout', 600), tail=200)
         warnings = []
         re_terrorist = re.compile(r'((Parsing)|(Compiling)) (([\w\d_]*Terrorist\w*)|(AmmoNone))')
         for line in errs.splitlines():
@@ -211,7 +618,7 @@ def compile(args, settings):
                 warnings.append(line)
     except Exception as e:
         displayCompileError(e)
-        return (1, None)
+        return CompileResult(1, None, graph)
 
     # TODO: if ret != 0 we should show the end of UCC.log, we could also keep track of compiler warnings to show at the end after the test results
 
@@ -220,7 +627,10 @@ def compile(args, settings):
         if not exists(file):
             raise RuntimeError("could not find file after compiling: "+file)
 
-    return (ret, warnings)
+    if fingerprint and ret == 0:
+        fingerprint.save(warnings)
+
+    return CompileResult(ret, warnings, graph)
 
 
 def displayCompileError(e):
@@ -0,0 +1,123 @@
+# --daemon mode, stays running with the parse caches in memory and builds whenever a client asks over a unix socket or named pipe
+# messages are json inside of multiprocessing.connection's framing (a 4 byte big endian length and then the bytes)
+# json instead of pickle so nothing that connects can make the daemon run code, and so editor plugins don't need python
+from compiler.base import *
+from multiprocessing.connection import Listener, Client
+import hashlib
+import json
+import tempfile
+
+
+def default_address() -> str:
+    # one daemon per mod folder, since the settings files are relative to the working directory
+    name = 'unrealscript-injector-' + hashlib.md5(os.getcwd().encode('utf-8')).hexdigest()[:12]
+    if sys.platform == 'win32':
+        return '\\\\.\\pipe\\' + name
+    return os.path.join(tempfile.gettempdir(), name + '.sock')
+
+
+def address_family(address) -> str:
+    if address.startswith('\\\\.\\pipe\\'):
+        return 'AF_PIPE'
+    return 'AF_UNIX'
+
+
+def send(conn, message):
+    conn.send_bytes(json.dumps(message).encode('utf-8'))
+
+
+def recv(conn) -> dict:
+    return json.loads(conn.recv_bytes().decode('utf-8'))
+
+
+def remove_stale_socket(address):
+    # a daemon that crashed leaves its socket file behind, which would make the Listener fail
+    if address_family(address) != 'AF_UNIX' or not os.path.exists(address):
+        return
+    try:
+        with Client(address, 'AF_UNIX'):
+            pass
+    except OSError:
+        os.remove(address)
+        return
+    raise RuntimeError('a daemon is already listening on '+address)
+
+
+def serve(args, address=None):
+    address = address or default_address()
+    family = address_family(address)
+    remove_stale_socket(address)
+    args.keep_caches = True
+    with Listener(address, family) as listener:
+        if family == 'AF_UNIX':
+            os.chmod(address, 0o600)
+        notice(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ": build daemon listening on "+address)
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError as e:
+                printError("daemon failed to accept a connection: "+repr(e))
+                continue
+            with conn:
+                try:
+                    message = recv(conn)
+                except (EOFError, OSError, ValueError) as e:
+                    printError("daemon got a bad request: "+repr(e))
+                    continue
+                if not isinstance(message, dict):
+                    message = {}
+                    response = {'success': False, 'error': 'the request must be a json object'}
+                else:
+                    # one bad request shouldn't take the daemon down for everyone else
+                    try:
+                        response = handle(args, message)
+                    except Exception as e:
+                        printError("daemon failed to handle "+repr(message)+": "+repr(e))
+                        response = {'success': False, 'command': message.get('command'), 'error': repr(e), 'traceback': traceback.format_exc()}
+                try:
+                    send(conn, response)
+                except (OSError, TypeError, ValueError) as e:
+                    printError("daemon failed to send the response: "+repr(e))
+            if message.get('command') == 'stop':
+                notice("build daemon stopping")
+                return
+
+
+def handle(args, message) -> dict:
+    command = message.get('command', 'build')
+    if command in ('ping', 'stop'):
+        return {'success': True, 'command': command}
+    if command != 'build':
+        return {'success': False, 'command': command, 'error': 'unknown command: '+repr(command)}
+
+    profile = message.get('profile') or args.profile or 'all'
+    notice(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ": daemon compiling "+profile+"...")
+    start = timer()
+    response = {'success': False, 'command': command, 'profile': profile, 'profiles': []}
+    try:
+        # walk the folders again, the parse cache only reads the files whose stats changed since the last build
+        file_indexes.clear()
+        args.profile = profile
+        results = args.compiler.run(args)
+        response['profiles'] = results
+        response['success'] = len(results) > 0 and all(r['success'] for r in results)
+    except Exception as e:
+        printError('\n\ncompile error: ')
+        print(traceback.format_exc())
+        printError("----------------")
+        response['error'] = repr(e)
+        response['traceback'] = traceback.format_exc()
+    response['timings'] = {'total': timer() - start}
+    notice("build took "+str(response['timings']['total'])+" seconds")
+    return response
+
+
+def request(message, address=None) -> dict:
+    address = address or default_address()
+    with Client(address, address_family(address)) as conn:
+        send(conn, message)
+        return recv(conn)
+
+
+def request_build(profile, address=None) -> dict:
+    return request({'command': 'build', 'profile': profile}, address)
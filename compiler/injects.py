@@ -1,12 +1,13 @@
 # injects means our class will take the place of the baseclass, and the baseclass will have "InjBase" appended to the end of its name
 # class DXRHuman injects Human; will be saved as class Human extends HumanInjBase; and the original Human class will be saved as HumanInjBase
 from compiler.base import *
+import compiler.lexer as lexer
 
 disabled = False
 whitelist = []
 classPostfix = "InjBase"
 
-def before_write(mod, f, injects):
+def before_write(mod, f, injects, children=None):
     pass
 
 def execute_injections(f, prev, idx, inject, injects):
@@ -22,8 +23,9 @@ def execute_injections(f, prev, idx, inject, injects):
     newclassname = oldclassname+classPostfix
 
     debug(f.qualifiedclass + ' has '+ str(len(injects)) +' injections, renaming to '+newclassname )
+    # only in code, not in comments or strings or the defaultproperties, and before modify_classline so we can use the token stream from the reader
+    f.content = f.get_lexed().sub_code(lexer.re_self, oldclassname+'(Self)', False)
     f.modify_classline(newclassname, f.operator, f.baseclass)
-    f.content = re.sub('([^a-z_])(self)([^a-z_])', r'\1'+oldclassname+r'(Self)\3', f.content, flags=re.IGNORECASE)
     return True
 
 
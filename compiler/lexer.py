@@ -0,0 +1,95 @@
+# splits UnrealScript into comments, strings, names and code, so the reader and the operators don't each need their own regexes that trip over // inside of strings
+from compiler.base import *
+
+COMMENT = 'comment'
+STRING = 'string'
+NAME = 'name'
+CODE = 'code'
+
+# strings and names can't span lines, an unterminated one just ends at the newline
+re_token = re.compile(
+    r'(?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))'
+    + r'|(?P<string>"(?:[^"\\\n]|\\[^\n])*"?)'
+    + r"|(?P<name>'(?:[^'\\\n]|\\[^\n])*'?)"
+    + r"|(?P<code>[^/\"']+|/)",
+    flags=re.DOTALL
+)
+re_defaultproperties = re.compile(r'(?<![\w])defaultproperties(?![\w])', flags=re.IGNORECASE)
+re_self = re.compile(r'(?<![\w])self(?![\w])', flags=re.IGNORECASE)
+
+
+def tokenize(content) -> list:
+    # returns a list of (kind, start, end), neighboring code gets joined together
+    tokens = []
+    for m in re_token.finditer(content):
+        kind = m.lastgroup
+        if kind == CODE and tokens and tokens[-1][0] == CODE:
+            tokens[-1] = (CODE, tokens[-1][1], m.end())
+        else:
+            tokens.append((kind, m.start(), m.end()))
+    return tokens
+
+
+class Lexed():
+    # the token stream for one version of a file's content, UnrealScriptFile.get_lexed() caches it
+    def __init__(self, content):
+        self.content = content
+        self.tokens = tokenize(content)
+        # the defaultproperties block is always at the end of the class
+        self.defaultproperties = len(content)
+        for kind, start, end in self.tokens:
+            if kind != CODE:
+                continue
+            m = re_defaultproperties.search(content, start, end)
+            if m:
+                self.defaultproperties = m.start()
+                break
+
+    def strip_comments(self) -> str:
+        # every comment becomes a single space, same as the old regexes did
+        parts = []
+        for kind, start, end in self.tokens:
+            if kind == COMMENT:
+                parts.append(' ')
+            else:
+                parts.append(self.content[start:end])
+        return ''.join(parts)
+
+    def code_spans(self, include_defaultproperties=True):
+        for kind, start, end in self.tokens:
+            if kind != CODE:
+                continue
+            if not include_defaultproperties:
+                if start >= self.defaultproperties:
+                    break
+                end = min(end, self.defaultproperties)
+            yield start, end
+
+    def find(self, sub) -> int:
+        # like str.find, but skips matches that start inside of a comment, string or name, like a commented out classline
+        # a match can still start with a whole comment, like the "// === was" line in front of a modified classline
+        found = self.content.find(sub)
+        i = 0
+        while found != -1:
+            while self.tokens[i][2] <= found:
+                i += 1
+            kind, start, end = self.tokens[i]
+            if kind == CODE or start == found:
+                return found
+            found = self.content.find(sub, end)
+        return -1
+
+    def sub_code(self, regex, repl, include_defaultproperties=True) -> str:
+        # regex substitution only inside of code, comments and strings and names are left alone
+        parts = []
+        last = 0
+        for start, end in self.code_spans(include_defaultproperties):
+            parts.append(self.content[last:start])
+            parts.append(regex.sub(repl, self.content[start:end]))
+            last = end
+        parts.append(self.content[last:])
+        return ''.join(parts)
+
+
+def strip_comments(content) -> str:
+    return Lexed(content).strip_comments()
@@ -4,7 +4,7 @@ from compiler.base import *
 disabled = False
 whitelist = []
 
-def before_write(mod, f, injects):
+def before_write(mod, f, injects, children=None):
     pass
 
 def execute_injections(f, prev, idx, inject, injects):
@@ -12,64 +12,115 @@ def execute_injections(f, prev, idx, inject, injects):
     if disabled and f.classname not in whitelist:
         return True
 
-    f.content = apply_merge(f, f.content, inject)
+    # multiple merges into the same class get collected, and then applied once in finish_injections
+    if getattr(f, 'merged_content', None) is None:
+        f.merged_content = MergedContent(f.content)
+    f.merged_content.add(inject)
     return True
 
 
+def finish_injections(f):
+    if getattr(f, 'merged_content', None) is None:
+        return
+    f.content = f.merged_content.materialize()
+    f.merged_content = None
+
+
 def handle_inheritance_operator(f, injects):
     return False
 
 
 def apply_merge(a, orig_content, b):
-    #Find variable definitions in b (file to be merged)
-    bVars=[]
-    bRest=[]
-    for line in b.content.split("\n"):
-        if line.startswith("var "):
-            bVars.append(line)
-        else:
-            bRest.append(line)
-
-    if bVars!="":
-        merged = []
-        aContent = orig_content.split("\n")
-        lastVarLine = 0
-
-        for line in aContent:
+    merged = MergedContent(orig_content)
+    merged.add(b)
+    return merged.materialize()
+
+
+pattern_pre = r'(?P<prefix>(?P<functype>function|event)\s+(?P<types>[^\(;\/]+\s+)?)'
+pattern_mid = r'(?P<name>[^\s\(;]+)'
+pattern_post = r'(?P<end>\s*\()'
+re_function = re.compile(pattern_pre+pattern_mid+pattern_post, flags=re.IGNORECASE)
+
+
+class MergedContent():
+    # the content of a class with any number of merges appended, kept as a list of lines
+    # each line remembers which merge's function renames apply to it, so all the renames happen in a single pass at the end
+    def __init__(self, content):
+        self.lines = content.split("\n")
+        self.since = [0] * len(self.lines) # index into self.renames of the first merge that renames functions in this line
+        self.renames = []
+        self.lastVarLine = 0
+        for i, line in enumerate(self.lines):
+            if line.strip().startswith("var "):
+                self.lastVarLine = i
+
+    def add(self, b):
+        #Find variable definitions in b (file to be merged)
+        bVars=[]
+        bRest=[]
+        for line in b.content.split("\n"):
+            if line.startswith("var "):
+                bVars.append(line)
+            else:
+                bRest.append(line)
+
+        merge = len(self.renames)
+        varlines = ["//=======Start of variables merged from "+b.mod_name+'/'+b.classname+"======="]
+        varlines += bVars
+        varlines.append("//=======End of variables merged from "+b.mod_name+'/'+b.classname+"=========")
+        pos = self.lastVarLine + 1
+        self.lines[pos:pos] = varlines
+        self.since[pos:pos] = [merge] * len(varlines)
+        if bVars:
+            self.lastVarLine = pos + len(varlines) - 2
+
+        b_content = "\n".join(bRest)
+        b_content = re.sub(b.classline, "/* "+b.classline+" */", b_content, count=1)
+        # the var lines and the classline can't have functions in them, so b's own token stream works
+        b_content_no_comments = b.get_lexed().strip_comments()
+
+        renames = {}
+        for i in re_function.finditer(b_content_no_comments):
+            debug( "merging found: " + repr(i.groupdict()) )
+            # the first declaration wins, just like it would with a re.sub per function
+            renames.setdefault(i.group('name').lower(), (i.group('prefix'), i.group('name'), i.group('end')))
+        self.renames.append(renames)
+
+        blines = ['', "// === merged from "+b.mod_name+'/'+b.classname, ''] + b_content.split("\n")
+        start = len(self.lines)
+        self.lines += blines
+        self.since += [merge + 1] * len(blines)
+        for i, line in enumerate(blines):
             if line.strip().startswith("var "):
-                lastVarLine = aContent.index(line)
-
-        merged+=aContent[:lastVarLine+1]
-
-        merged.append("//=======Start of variables merged from "+b.mod_name+'/'+b.classname+"=======")
-        merged+=bVars
-        merged.append("//=======End of variables merged from "+b.mod_name+'/'+b.classname+"=========")
-        merged+=aContent[lastVarLine+1:]
-
-        content="\n".join(merged)
-
-    else:
-        content = orig_content
-
-    content += "\n\n// === merged from "+b.mod_name+'/'+b.classname+"\n\n"
-    b_content = "\n".join(bRest)
-    b_content = re.sub(b.classline, "/* "+b.classline+" */", b_content, count=1)
-    b_content_no_comments = b.strip_comments(b_content)
-
-    pattern_pre = r'(?P<prefix>(?P<functype>function|event)\s+(?P<types>[^\(;\/]+\s+)?)'
-    pattern_mid = r'(?P<name>[^\s\(;]+)'
-    pattern_post = r'(?P<end>\s*\()'
-    r = re.compile(pattern_pre+pattern_mid+pattern_post, flags=re.IGNORECASE)
-    for i in r.finditer(b_content_no_comments):
-        debug( "merging found: " + repr(i.groupdict()) )
-        prefix = i.group('prefix')
-        func = i.group('name')
-        end = i.group('end')
-        content = re.sub( \
-            pattern_pre + re.escape(func) + pattern_post, \
-            prefix+'_'+func+end, \
-            content, \
-            flags=re.IGNORECASE \
-        )
-
-    return content + b_content
+                self.lastVarLine = start + i
+
+    def materialize(self) -> str:
+        out = []
+        start = 0
+        # group runs of lines that get the same renames
+        for i in range(1, len(self.lines) + 1):
+            if i < len(self.lines) and self.since[i] == self.since[start]:
+                continue
+            text = "\n".join(self.lines[start:i])
+            renames = self.renames[self.since[start]:]
+            if renames and any(renames):
+                text = re_function.sub(lambda m: self.rename(m, renames), text)
+            out.append(text)
+            start = i
+        return "\n".join(out)
+
+    @staticmethod
+    def rename(match, renames):
+        prefix = match.group('prefix')
+        name = match.group('name')
+        end = match.group('end')
+        changed = False
+        # later merges rename the already renamed function again, the same as applying each merge in order
+        for r in renames:
+            found = r.get(name.lower())
+            if found:
+                prefix, name, end = found[0], '_'+found[1], found[2]
+                changed = True
+        if not changed:
+            return match.group(0)
+        return prefix+name+end
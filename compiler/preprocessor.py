@@ -1,42 +1,181 @@
 # handles ifdef so we can exclude/include code depending on compiler flags, like if we want to build on top of another mod
 from compiler.base import *
 
-# in (?=(?P<next>#\w+))
-# the # symbol is for a lookahead
-# because we want to read up until the next preprocessor directive (like the next #elseif, #else, or #endif)
-# but we don't want to swallow it yet
-re_split_ifdef = re.compile(r'(?P<ifdef>#[^\s]+)( (?P<cond>[^\n]+))?\n(?P<code>.*?)\n[ \t]*(?=(?P<next>#\w+))', flags=re.DOTALL)
-
-re_comment_out = re.compile(r'^', flags=re.MULTILINE) # for a regex substitution with //
 re_compileif = re.compile(r'(#dontcompileif|#compileif) (.+)')
-re_replace_vars = re.compile(r'#(bool|defined|var|switch|0b|bit)\((.+?)\)')
+re_replace_vars = re.compile(r'#(bool|defined|var|switch|0b|bit)\(')
+re_var_inside = re.compile(r'[^()\n]+\)') # most of them don't have nested parentheses
 
-# for finding the start and end of an ifdef block:
-re_find_ifdefs = re.compile(r'((#ifdef )|(#ifndef ))(.*?)(#endif)', flags=re.DOTALL)
+directives = {'#ifdef', '#ifndef', '#elseif', '#elseifn', '#else', '#endif'}
 
-def proc_conditions(cond, definitions, asBool=False): # is this a #bool or #defined?
-    if '(' in cond or ')' in cond:
-        raise RuntimeError("We don't currently support parenthesis in preprocessor conditions: " + cond)
-    if '&&' in cond:
-        if '||' in cond:
-            raise RuntimeError("We don't currently support mixed && with || in preprocessor conditions: " + cond)
-        ands = True
-        vars = cond.split('&&')
-    else:
-        ands = False
-        vars = cond.split('||')
-
-    for var in vars:
-        val = definitions.get(var.strip())
-        if asBool and not val:
-            val = None
-        if val is not None:
-            if not ands:
-                return True
-        elif ands:
+# for finding which definitions a file depends on, a superset is fine
+re_directive_conds = re.compile(r'#(?:ifdef|ifndef|elseif|elseifn|compileif|dontcompileif)[ \t]+([^\n/]+)')
+re_cond_names = re.compile(r'[^\s&|()!,:]+')
+
+def referenced_definitions(content) -> set:
+    refs = set()
+    if '#' not in content:
+        return refs
+    for i in re_directive_conds.finditer(content):
+        refs.update(re_cond_names.findall(i.group(1)))
+    for (start, end, type, inside) in find_vars(content):
+        if type in ('0b', 'bit'):
+            continue
+        refs.update(re_cond_names.findall(inside))
+    return refs
+
+
+def find_vars(text):
+    # yields (start, end, type, inside) for each #var(...) and the others, the conditions inside can have their own parentheses
+    # so this finds the matching ) instead of the first one, anything unbalanced on its line is left alone
+    pos = 0
+    while True:
+        m = re_replace_vars.search(text, pos)
+        if not m:
+            return
+        simple = re_var_inside.match(text, m.end())
+        if simple:
+            yield (m.start(), simple.end(), m.group(1), text[m.end():simple.end()-1])
+            pos = simple.end()
+            continue
+        depth = 1
+        i = m.end()
+        while i < len(text) and depth:
+            c = text[i]
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+            elif c == '\n':
+                break
+            i += 1
+        if depth or i - 1 == m.end():
+            pos = m.end()
+            continue
+        yield (m.start(), i, m.group(1), text[m.end():i-1])
+        pos = i
+
+
+def replace_vars(line, definitions):
+    out = []
+    pos = 0
+    for (start, end, type, inside) in find_vars(line):
+        out.append(line[pos:start])
+        out.append(replace_var(type, inside, definitions))
+        pos = end
+    if not out:
+        return line
+    out.append(line[pos:])
+    return ''.join(out)
+
+re_cond_tokens = re.compile(r'\s*(&&|\|\||!|\(|\)|[^\s&|()!]+)')
+compiled_conditions = {}
+
+class Condition():
+    # a condition string parsed into a small expression tree, && binds tighter than ||, and ! negates
+    # nodes are ('var', name), ('not', node), ('and', [nodes]), ('or', [nodes])
+    def __init__(self, cond):
+        self.cond = cond
+        self.tokens = self.tokenize(cond)
+        self.pos = 0
+        self.names = set()
+        self.tree = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise RuntimeError("Unexpected " + self.tokens[self.pos] + " in preprocessor condition: " + cond)
+        del self.tokens
+
+    @staticmethod
+    def tokenize(cond):
+        tokens = []
+        pos = 0
+        cond = cond.rstrip()
+        while pos < len(cond):
+            m = re_cond_tokens.match(cond, pos)
+            if not m:
+                raise RuntimeError("Can't parse preprocessor condition: " + cond)
+            tokens.append(m.group(1))
+            pos = m.end()
+        return tokens
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise RuntimeError("Unexpected end of preprocessor condition: " + self.cond)
+        self.pos += 1
+        return token
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == '||':
+            self.pos += 1
+            nodes.append(self.parse_and())
+        if len(nodes) == 1:
+            return nodes[0]
+        return ('or', nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_unary()]
+        while self.peek() == '&&':
+            self.pos += 1
+            nodes.append(self.parse_unary())
+        if len(nodes) == 1:
+            return nodes[0]
+        return ('and', nodes)
+
+    def parse_unary(self):
+        token = self.next()
+        if token == '!':
+            return ('not', self.parse_unary())
+        if token == '(':
+            node = self.parse_or()
+            if self.next() != ')':
+                raise RuntimeError("Missing ) in preprocessor condition: " + self.cond)
+            return node
+        if token in ('&&', '||', ')'):
+            raise RuntimeError("Unexpected " + token + " in preprocessor condition: " + self.cond)
+        self.names.add(token)
+        return ('var', token)
+
+    def evaluate(self, definitions, asBool=False):
+        return self.evaluate_node(self.tree, definitions, asBool)
+
+    @classmethod
+    def evaluate_node(cls, node, definitions, asBool):
+        op = node[0]
+        if op == 'var':
+            val = definitions.get(node[1])
+            if asBool:
+                return bool(val)
+            return val is not None
+        elif op == 'not':
+            return not cls.evaluate_node(node[1], definitions, asBool)
+        elif op == 'and':
+            for n in node[1]:
+                if not cls.evaluate_node(n, definitions, asBool):
+                    return False
+            return True
+        else:
+            for n in node[1]:
+                if cls.evaluate_node(n, definitions, asBool):
+                    return True
             return False
 
-    return ands
+
+def compile_condition(cond) -> Condition:
+    c = compiled_conditions.get(cond)
+    if c is None:
+        # like #ifdef vanilla // comment
+        c = Condition(cond.split('//', 1)[0])
+        compiled_conditions[cond] = c
+    return c
+
+
+def proc_conditions(cond, definitions, asBool=False): # is this a #bool or #defined?
+    return compile_condition(cond).evaluate(definitions, asBool)
 
 
 def bIfdef(ifdef, cond, definitions):
@@ -51,122 +190,298 @@ def bIfdef(ifdef, cond, definitions):
     raise RuntimeError("Unknown preprocessor "+ifdef+' '+cond)
 
 
-def preprocess(content: str, ifdef: str, definitions: dict):
-    removed_code_before = ''
-    removed_code_after = ''
-    replacement = None
-    counts = {'#ifdef':0, '#ifndef':0, '#else':0, '#elseif':0, '#elseifn':0}
+class IfdefBlock():
+    # one level of the #ifdef stack
+    def __init__(self, parent_active, linenum):
+        self.parent_active = parent_active
+        self.linenum = linenum
+        self.active = False
+        self.taken = False
+        self.counts = {'#ifdef':0, '#ifndef':0, '#else':0, '#elseif':0, '#elseifn':0}
+
+
+def proc_directive(stack, directive, cond, linenum, definitions):
+    # returns whether the lines after this directive are active
+    if directive == '#ifdef' or directive == '#ifndef':
+        parent_active = stack[-1].active if stack else True
+        stack.append(IfdefBlock(parent_active, linenum))
+    elif not stack:
+        raise Exception(directive+" on line "+str(linenum+1)+" without an #ifdef")
+    block = stack[-1]
 
-    for i in re_split_ifdef.finditer(ifdef):
-        counts[i.group('ifdef')] += 1
+    if directive == '#endif':
+        # warnings
+        num_lines = linenum - block.linenum
+        if num_lines > 200:
+            # this is a strong warning to refactor the code
+            raise Exception("ifdef on line "+str(block.linenum+1)+" is "+str(num_lines)+" lines long!")
+        stack.pop()
+        return stack[-1].active if stack else True
 
-        ifdeftext = i.group('ifdef')
-        if i.group('cond'):
-            ifdeftext += ' ' + i.group('cond')
-        ifdeftext += '\n'
-        blocktext = ifdeftext + i.group('code')
-        if i.group('next'):
-            blocktext += '\n'
-        commentedtext = re_comment_out.sub('//', blocktext)
+    if block.counts['#else'] > 0:
+        raise Exception(directive+" on line "+str(linenum+1)+" comes after an #else")
+    block.counts[directive] += 1
+    if block.counts['#elseif'] + block.counts['#elseifn'] > 20:
+        # this is a strong warning to refactor the code
+        raise Exception("ifdef on line "+str(block.linenum+1)+" has "+str(block.counts['#elseif'] + block.counts['#elseifn'])+" #elseifs/#elseifns")
 
-        if replacement is not None:
-            removed_code_after += commentedtext
+    if block.taken or not block.parent_active:
+        block.active = False
+    else:
+        block.active = bIfdef(directive, cond, definitions)
+        block.taken = block.active
+    return block.active
 
-        elif bIfdef(i.group('ifdef'), i.group('cond'), definitions):
-            removed_code_before += '//' + ifdeftext
-            replacement = i.group('code')
-            removed_code_after += '\n'
 
-        elif replacement is None:
-            removed_code_before += commentedtext
+def replace_var(type, var, definitions):
+    if type=='bool': # python's bool rules
+        return str(proc_conditions(var, definitions, True))
+    elif type=='0b':
+        return str(int(var, 2))
+    elif type=='bit':
+        args = var.split(',')
+        num = 0
+        for v in args:
+            num = num | (1 << int(v))
+        return str(num)
+    elif type=='switch': # like a ternary as #switch(var: resultiftrue, elseresult), or like #switch(cond1: result1, elseif2: result2, elseif3: result3, else: elseresult4)
+        args = var.split(',')
+        for j in range(len(args)):
+            result = args[j]
+            if ':' in result:
+                (cond, result) = result.split(':', 1)
+                cond = cond.strip()
+            else:
+                cond = 'else' # default to an else, like a ternary
 
-        if i.group('next') == '#endif':
-            removed_code_after += '//#endif'
+            if cond != 'else':
+                cond = proc_conditions(cond, definitions, True)
+            if cond:
+                return result
+        return ''
+    elif type=='defined': # if defined or undefined, ignoring value
+        return str(proc_conditions(var, definitions, False))
+    elif type=='var': # the value of the variable
+        return str(definitions.get(var, 'None'))
+    return '#'+type+'('+var+')'
 
-    # warnings
-    num_lines = ifdef.count('\n')
-    if num_lines > 200:
-        # this is a strong warning to refactor the code
-        raise Exception("ifdef is "+str(num_lines)+" lines long!")
-    if counts['#ifdef'] + counts['#ifndef'] != 1:
-        print(counts)
-        raise Exception("ifdef has "+str(counts['#ifdef'] + counts['#ifndef'])+" #ifdefs/#ifndefs")
-    if counts['#elseif'] + counts['#elseifn'] > 20:
-        # this is a strong warning to refactor the code
-        raise Exception("ifdef has "+str(counts['#elseif'] + counts['#elseifn'])+" #elseifs/#elseifns")
-    if counts['#else'] > 1:
-        raise Exception("ifdef has "+str(counts['#else'])+" #elses")
 
-    if replacement is None:
-        replacement = ""
+templates = {}
+
+def preprocessor(content, definitions, key=None):
+    return get_template(content, key).instantiate(definitions)
+
+
+def get_template(content, key=None):
+    # key is usually the file path, so a file that changes in --watch mode replaces its old template
+    # static files aren't kept, most of the vanilla source is like that, even the ones with #exec lines
+    if '#' not in content:
+        return Template(content)
+    if key is None:
+        key = content
+    t = templates.get(key)
+    if t is None or t.content != content:
+        t = Template(content)
+        if t.static:
+            templates.pop(key, None)
+        else:
+            templates[key] = t
+    return t
+
+
+TEXT = 0
+VARS = 1
+BRANCH = 2
+COMPILEIF = 3
+ERROR = 4
+
+class Template():
+    # everything the preprocessor does that doesn't depend on the definitions, done once per file
+    # ops are in line order, so compileifs and errors happen at the same point that preprocess_lines would hit them
+    # instantiate() only evaluates the conditions and joins the text, and profiles with equal values for refs share the result
+    def __init__(self, content):
+        self.content = content
+        self.refs = frozenset(referenced_definitions(content))
+        self.static = '#' not in content
+        self.dynamic = False
+        self.ops = []
+        self.blocks = [] # the parent branch of each #ifdef block, -1 is the top level
+        self.num_branches = 0
+        self.instances = {}
+        if not self.static:
+            self.compile()
+
+    def __getstate__(self):
+        # the instances would double what gets sent to and from the reader processes
+        state = dict(self.__dict__)
+        state['instances'] = {}
+        return state
+
+    def compile(self):
+        num_lines = self.content.count('\n')
+        stack = []
+        branch = -1
+        for linenum, line in enumerate(self.content.split('\n')):
+            if '#' in line:
+                if 'compileif' in line:
+                    i = re_compileif.search(line)
+                    if i:
+                        self.ops.append((COMPILEIF, i.group(1), i.group(2)))
+                        line = line[:i.start()] + '// ' + line[i.start():]
+
+                has_vars = next(find_vars(line), None)
+                stripped = line.lstrip()
+                if stripped.startswith('#'):
+                    parts = stripped.split(None, 1)
+                    if parts[0] in directives:
+                        if has_vars:
+                            # the condition would depend on the definitions, rare enough to just do it the slow way
+                            self.dynamic = True
+                            self.ops = []
+                            return
+                        cond = parts[1] if len(parts) > 1 else ''
+                        branch = self.compile_directive(stack, branch, parts[0], cond, linenum)
+                        if branch is None:
+                            return
+                        self.add_text(-1, line[:len(line)-len(stripped)] + '//' + stripped)
+                        continue
 
+                if has_vars:
+                    self.ops.append((VARS, branch, line))
+                    continue
 
-    replacement = removed_code_before + replacement + removed_code_after
-    return content.replace( ifdef, replacement )
+            self.add_text(branch, line)
 
+        if stack:
+            self.ops.append((ERROR, "ifdef on line "+str(stack[-1][1]+1)+" has no #endif"))
+        assert num_lines + 1 == sum(op[2].count('\n') if op[0] == TEXT else 1 for op in self.ops if op[0] in (TEXT, VARS))
+        if all(op[0] == TEXT and op[1] < 0 for op in self.ops):
+            # no directives and no vars, like the #exec lines in vanilla classes
+            self.static = True
+            self.ops = []
 
-def replace_checkcompile(content, definitions):
-    content_out = content
-    for i in re_compileif.finditer(content):
-        cond = proc_conditions(i.group(2), definitions)
-        if i.group(1) == '#dontcompileif' and cond:
+    def compile_directive(self, stack, branch, directive, cond, linenum):
+        # the same checks as proc_directive, returns the branch for the lines after this, or None after an error
+        if directive == '#ifdef' or directive == '#ifndef':
+            stack.append((len(self.blocks), linenum, {'#ifdef':0, '#ifndef':0, '#else':0, '#elseif':0, '#elseifn':0}))
+            self.blocks.append(branch)
+        elif not stack:
+            self.ops.append((ERROR, directive+" on line "+str(linenum+1)+" without an #ifdef"))
             return None
-        elif i.group(1) == '#compileif' and not cond:
+        (block, block_linenum, counts) = stack[-1]
+
+        if directive == '#endif':
+            num_lines = linenum - block_linenum
+            if num_lines > 200:
+                self.ops.append((ERROR, "ifdef on line "+str(block_linenum+1)+" is "+str(num_lines)+" lines long!"))
+                return None
+            stack.pop()
+            return self.blocks[block]
+
+        if counts['#else'] > 0:
+            self.ops.append((ERROR, directive+" on line "+str(linenum+1)+" comes after an #else"))
+            return None
+        counts[directive] += 1
+        if counts['#elseif'] + counts['#elseifn'] > 20:
+            self.ops.append((ERROR, "ifdef on line "+str(block_linenum+1)+" has "+str(counts['#elseif'] + counts['#elseifn'])+" #elseifs/#elseifns"))
             return None
 
-        content_out = content_out.replace( i.group(0), '// ' + i.group(0) )
-    return content_out
+        branch = self.num_branches
+        self.num_branches += 1
+        self.ops.append((BRANCH, branch, block, directive, cond))
+        return branch
 
+    def add_text(self, branch, line):
+        # neighboring lines in the same branch get joined, along with their commented out version
+        commented = line if branch < 0 else '//' + line
+        if self.ops and self.ops[-1][0] == TEXT and self.ops[-1][1] == branch:
+            (kind, branch, text, commented_text) = self.ops[-1]
+            self.ops[-1] = (TEXT, branch, text + line + '\n', commented_text + commented + '\n')
+        else:
+            self.ops.append((TEXT, branch, line + '\n', commented + '\n'))
 
-def replace_vars(content, definitions):
-    content_out = content
-    for i in re_replace_vars.finditer(content):
-        type = i.group(1)
-        var = i.group(2)
-        if type=='bool': # python's bool rules
-            text = str(proc_conditions(var, definitions, True))
-        elif type=='0b':
-            text = str(int(var, 2))
-        elif type=='bit':
-            args = var.split(',')
-            num = 0
-            for v in args:
-                num = num | (1 << int(v))
-            text = str(num)
-        elif type=='switch': # like a ternary as #switch(var: resultiftrue, elseresult), or like #switch(cond1: result1, elseif2: result2, elseif3: result3, else: elseresult4)
-            args = var.split(',')
-            text = ''
-            for j in range(len(args)):
-                result = args[j]
-                if ':' in result:
-                    (cond, result) = result.split(':')
-                    cond = cond.strip()
-                else:
-                    cond = 'else' # default to an else, like a ternary
-
-                if cond != 'else':
-                    cond = proc_conditions(cond, definitions, True)
-                if cond:
-                    text = result
-                    break
-        elif type=='defined': # if defined or undefined, ignoring value
-            text = str(proc_conditions(var, definitions, False))
-        elif type=='var': # the value of the variable
-            text = str(definitions.get(var, 'None'))
-        content_out = content_out.replace(i.group(0), text)
+    def instantiate(self, definitions):
+        if self.static:
+            return self.content
+        if self.dynamic:
+            return preprocess_lines(self.content, definitions)
+        key = tuple((k, repr(definitions.get(k))) for k in sorted(self.refs))
+        if key in self.instances:
+            return self.instances[key]
+        content = self.evaluate(definitions)
+        self.instances[key] = content
+        return content
 
-    return content_out
+    def evaluate(self, definitions):
+        out = []
+        active = [False] * self.num_branches
+        taken = [False] * len(self.blocks)
+        for op in self.ops:
+            kind = op[0]
+            if kind == TEXT:
+                out.append(op[2] if op[1] < 0 or active[op[1]] else op[3])
+            elif kind == VARS:
+                line = replace_vars(op[2], definitions)
+                out.append(line + '\n' if op[1] < 0 or active[op[1]] else '//' + line + '\n')
+            elif kind == BRANCH:
+                (kind, branch, block, directive, cond) = op
+                parent = self.blocks[block]
+                if taken[block] or (parent >= 0 and not active[parent]):
+                    active[branch] = False
+                else:
+                    active[branch] = bIfdef(directive, cond, definitions)
+                    taken[block] = active[branch]
+            elif kind == COMPILEIF:
+                cond = proc_conditions(op[2], definitions)
+                if op[1] == '#dontcompileif' and cond:
+                    return None
+                elif op[1] == '#compileif' and not cond:
+                    return None
+            else:
+                raise Exception(op[1])
+        # every line got a newline, but the last line didn't have one
+        return ''.join(out)[:-1]
 
 
-def preprocessor(content, definitions):
-    # TODO: doesn't yet support nested preprocessor definitions
+def preprocess_lines(content, definitions):
+    # a single pass over the lines, supports nested #ifdefs, the Template does the same thing in two steps
+    # removed lines and the directives get commented out instead of deleted, so the line numbers in UCC's errors still match
+    if '#' not in content:
+        return content
     num_lines = content.count('\n')
-    content = replace_checkcompile(content, definitions)
-    if not content:
-        return None
-    content = replace_vars(content, definitions)
-    content_out = content
-    for i in re_find_ifdefs.finditer(content):
-        content_out = preprocess(content_out, i.group(0), definitions)
+    out = []
+    stack = []
+    active = True
+    for linenum, line in enumerate(content.split('\n')):
+        if '#' in line:
+            if 'compileif' in line:
+                i = re_compileif.search(line)
+                if i:
+                    cond = proc_conditions(i.group(2), definitions)
+                    if i.group(1) == '#dontcompileif' and cond:
+                        return None
+                    elif i.group(1) == '#compileif' and not cond:
+                        return None
+                    line = line[:i.start()] + '// ' + line[i.start():]
+
+            line = replace_vars(line, definitions)
+
+            stripped = line.lstrip()
+            if stripped.startswith('#'):
+                parts = stripped.split(None, 1)
+                if parts[0] in directives:
+                    cond = parts[1] if len(parts) > 1 else ''
+                    active = proc_directive(stack, parts[0], cond, linenum, definitions)
+                    out.append(line[:len(line)-len(stripped)] + '//' + stripped)
+                    continue
+
+        if active:
+            out.append(line)
+        else:
+            out.append('//' + line)
+
+    if stack:
+        raise Exception("ifdef on line "+str(stack[-1].linenum+1)+" has no #endif")
+    content_out = '\n'.join(out)
     assert num_lines == content_out.count('\n')
     return content_out
@@ -1,31 +1,40 @@
 # read and parse UC files
 from compiler.base import *
-
-subclasses = dict()
+import compiler.lexer as lexer
+import compiler.timing as timing
+import concurrent.futures
+import hashlib
+import importlib
+import multiprocessing
+import pickle
 
 class OtherFile():
-    def __init__(self, mod_name, file, filename, namespace, type):
+    # binary files are only a path and the stats, the writer copies them without reading them into memory
+    def __init__(self, mod_name, file, filename, namespace, type, entry=None):
         self.file = file
         self.mod_name = mod_name
         self.filename = filename
         self.namespace = namespace
         self.type = type
         self.content = None
+        self.binary = not filename.endswith('.txt')
+        if self.binary:
+            if entry is None:
+                st = os.stat(self.file)
+                self.size, self.mtime_ns = st.st_size, st.st_mtime_ns
+            else:
+                self.size, self.mtime_ns = entry.size, entry.mtime_ns
+            return
         with open(self.file, 'rb') as f:
             data = f.read()
-            self.binary = False
-            if filename.endswith('.txt'):
-                if data[:2] == b'\xfe\xff' or data[:2] == b'\xff\xfe': # 'ÿþ'
-                    self.content = data.decode('utf-16', 'replace')
-                    data = self.content.encode('utf-8', 'replace')
-                self.content = data.decode('windows-1252', 'ignore')
-                self.content = self.content.replace('\r\n', '\n')
-            else:
-                self.content = data
-                self.binary = True
+            if data[:2] == b'\xfe\xff' or data[:2] == b'\xff\xfe': # 'ÿþ'
+                self.content = data.decode('utf-16', 'replace')
+                data = self.content.encode('utf-8', 'replace')
+            self.content = data.decode('windows-1252', 'ignore')
+            self.content = self.content.replace('\r\n', '\n')
 
     @staticmethod
-    def ReadOtherFile(mod_name, file):
+    def ReadOtherFile(mod_name, file, entry=None):
         path = list(Path(file).parts)
         if len(path) <3:
             return None
@@ -42,23 +51,122 @@ class OtherFile():
 
         lowerfilename = filename.lower()
         if lowerfilename.endswith('.txt') or lowerfilename.endswith('.pcx') or lowerfilename.endswith('.wav') or lowerfilename.endswith('.mp3') or lowerfilename.endswith('.png'):
-            return OtherFile(mod_name, file, filename, namespace, type)
+            return OtherFile(mod_name, file, filename, namespace, type, entry)
         return None
 
 
 class UnrealScriptFile():
+    # slots because there's one of these for every vanilla class, the comment stripped text isn't kept since only the reader needs it
+    __slots__ = ('file', 'mod_name', 'binary', 'filename', 'namespace', 'parentfolder', 'type',
+        '_content', 'edits', 'classline_span', 'definitions_used', 'classline', 'classname', 'operator', 'baseclass', 'qualifiedclass',
+        'lexed', 'merged_content')
+
+    def __init__(self):
+        self.file = None
+        self.mod_name = None
+        self.binary = False
+        self.filename = None
+        self.namespace = None
+        self.parentfolder = None
+        self.type = None
+        self._content = None
+        # pending positional edits against _content, start -> (end, text), applied the next time someone reads content
+        self.edits = {}
+        self.classline_span = None
+        self.definitions_used = None
+        self.classline = None
+        self.classname = None
+        self.operator = None
+        self.baseclass = None
+        self.qualifiedclass = None
+        self.lexed = None
+        self.merged_content = None
+
+    @property
+    def content(self):
+        if self.edits:
+            self.apply_edits()
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        # the getter already applied any edits when the new value was made from the old one
+        self._content = value
+        self.edits = {}
+        self.classline_span = None
+
+    def edit(self, start, end, text):
+        self.edits[start] = (end, text)
+
+    def apply_edits(self):
+        parts = []
+        last = 0
+        for start in sorted(self.edits):
+            end, text = self.edits[start]
+            parts.append(self._content[last:start])
+            parts.append(text)
+            last = end
+        parts.append(self._content[last:])
+        self._content = ''.join(parts)
+        self.edits = {}
+        self.classline_span = None
+
+    def get_classline_span(self):
+        # where the classline is in _content, or None if it isn't in there verbatim (the old string replace didn't find those either)
+        if self.classline_span is None:
+            start = self.get_lexed().find(self.classline)
+            if start == -1:
+                return None
+            self.classline_span = (start, start + len(self.classline))
+        return self.classline_span
+
+    @property
+    def content_no_comments(self):
+        return self.get_lexed().strip_comments()
+
+    def release(self):
+        # for vanilla files that have been written and that no operator will look at again
+        self._content = None
+        self.edits = {}
+        self.classline_span = None
+        self.lexed = None
+
+    def get_state(self) -> dict:
+        state = {k: getattr(self, k) for k in self.__slots__}
+        if self.edits:
+            state['_content'] = self.content
+            state['classline_span'] = None
+        state['edits'] = {}
+        state.pop('lexed') # cheap to redo, not worth the disk space
+        state.pop('merged_content')
+        return state
+
+    @staticmethod
+    def from_state(state):
+        self = UnrealScriptFile()
+        for (k, v) in state.items():
+            setattr(self, k, v)
+        self.edits = {}
+        return self
+
     @staticmethod
-    def read_file(mod_name, file, preprocessor, definitions):
+    def read_file(mod_name, file, preprocessor, definitions, cache=None, entry=None):
+        if cache is not None:
+            hit, f = cache.load(file, mod_name, entry)
+            if hit:
+                return f
         self = UnrealScriptFile()
         self.file = file
         self.mod_name = mod_name
         self.binary = False
-        return self._read_file(preprocessor, definitions)
+        ret = self._read_file(preprocessor, definitions, entry.uc if entry else None)
+        if cache is not None:
+            cache.store(self, ret)
+        return ret
 
 
-    def _read_file(self, preprocessor, definitions):
-        global subclasses
-        success, self.filename, self.namespace, self.parentfolder, self.type = is_uc_file(self.file)
+    def _read_file(self, preprocessor, definitions, uc=None):
+        success, self.filename, self.namespace, self.parentfolder, self.type = uc or is_uc_file(self.file)
         if not success:
             raise RuntimeError( self.file + ' is not an unrealscript file!' )
 
@@ -70,12 +178,15 @@ class UnrealScriptFile():
                 data = self.content.encode('utf-8', 'replace')
             self.content = data.decode('windows-1252', 'ignore')
             self.content = self.content.replace('\r\n', '\n')
-        self.content = preprocessor.preprocessor(self.content, definitions)
+        # the template is shared by the profiles, injections is checked below so it always counts
+        template = preprocessor.get_template(self.content, self.file)
+        self.definitions_used = template.refs | {'injections'}
+        with timing.span('preprocess', self.file):
+            self.content = template.instantiate(definitions)
         if not self.content:
             info('skipping ' + self.file)
             return None
-        self.content_no_comments = self.strip_comments(self.content)
-        self.classline = self.get_class_line(self.content_no_comments)
+        self.classline = self.get_class_line(self.get_lexed().strip_comments())
         inheritance = re.search(r'class\s+(?P<classname>\S+)\s+(.*\s+)??((?P<operator>(injects)|(extends)|(expands)|(overwrites)|(merges)|(shims))\s+(?P<baseclass>[^\s;]+))?', self.classline, flags=re.IGNORECASE)
         self.classname = None
         self.operator = None
@@ -84,9 +195,6 @@ class UnrealScriptFile():
             self.classname = inheritance.group('classname')
             self.operator = inheritance.group('operator')
             self.baseclass = inheritance.group('baseclass')
-            a = subclasses.get(self.baseclass, [])
-            a.append(self.classname)
-            subclasses[self.baseclass] = a
         else:
             RuntimeError(self.file+" couldn't read class definition")
 
@@ -103,6 +211,7 @@ class UnrealScriptFile():
         comment += f.filename+' class '+f.classname+" ===\n"
 
         oldclassline = f.classline
+        span = f.get_classline_span()
 
         re_old = r'class\s+'+f.classname+r'\s+'+f.operator+r'\s+'+f.baseclass
         new_classline = comment + 'class '+classname+' '+operator+' '+baseclass
@@ -110,8 +219,10 @@ class UnrealScriptFile():
         f.classname = classname
         f.operator = operator
         f.baseclass = baseclass
-        #re.sub doesn't match for a multiline classline (like the harry class in HP2), so use a string replace
-        f.content = f.content.replace(oldclassline,f.classline)
+        #re.sub doesn't match for a multiline classline (like the harry class in HP2), so the whole classline gets replaced
+        # this only records the edit, so modifying the same class repeatedly doesn't copy the whole content every time
+        if span is not None:
+            f.edit(span[0], span[1], f.classline)
 
     def __repr__(self):
         return self.classline
@@ -126,35 +237,262 @@ class UnrealScriptFile():
             raise RuntimeError('Could not find classline')
         return classline
 
+    def get_lexed(self):
+        # the token stream is cached until the content changes
+        lexed = self.lexed
+        if lexed is None or lexed.content is not self.content:
+            lexed = lexer.Lexed(self.content)
+            self.lexed = lexed
+        return lexed
+
     @staticmethod
     def strip_comments(content):
-        content_no_comments = re.sub(r'//.*', ' ', content)
-        content_no_comments = re.sub(r'/\*.*?\*/', ' ', content_no_comments, flags=re.DOTALL)
-        return content_no_comments
+        return lexer.strip_comments(content)
+
+
+class ParseCache():
+    # remembers parsed UnrealScriptFiles between runs, so unchanged files skip the reader entirely
+    # entries are keyed by path, and checked against the size, mtime, mod name and the values of the definitions the file references
+    def __init__(self, path, definitions):
+        self.path = path
+        self.definitions = definitions
+        self.entries = {}
+        self.used = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('version') == cache_version():
+                self.entries = data['entries']
+            else:
+                info('parse cache is from a different compiler version, ignoring it')
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            notice('ignoring unreadable parse cache '+path+': '+repr(e))
+
+    def reset(self, definitions):
+        # start another build, everything used in the last build is still valid as long as the stats match
+        self.definitions = definitions
+        self.entries = self.used
+        self.used = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
 
+    def definitions_hash(self, refs):
+        values = [(k, self.definitions.get(k)) for k in sorted(refs)]
+        return hashlib.md5(repr(values).encode('utf-8')).hexdigest()
 
-def proc_file(file, files, mod_name, injects, preprocessor, definitions):
+    def load(self, file, mod_name, entry=None):
+        if entry is None:
+            entry = os.stat(file)
+            key = (entry.st_size, entry.st_mtime_ns, mod_name)
+        else:
+            key = (entry.size, entry.mtime_ns, mod_name)
+        entry = self.entries.get(file)
+        if entry is not None and entry[0] == key and entry[2] == self.definitions_hash(entry[1]):
+            self.hits += 1
+            self.used[file] = entry
+            if entry[3] is None:
+                return True, None
+            return True, UnrealScriptFile.from_state(entry[3])
+        self.misses += 1
+        self.pending[file] = key
+        return False, None
+
+    def store(self, f, ret):
+        key = self.pending.pop(f.file)
+        refs = tuple(sorted(f.definitions_used))
+        state = None
+        if ret is not None:
+            # copy the state now, before the operators start modifying the file
+            state = ret.get_state()
+        self.used[f.file] = (key, refs, self.definitions_hash(refs), state)
+        self.dirty = True
+
+    def save(self):
+        # entries that weren't used this run are dropped, so deleted files don't pile up
+        if not self.dirty and len(self.used) == len(self.entries):
+            return
+        debug('saving parse cache with '+str(len(self.used))+' entries to '+self.path)
+        temp = self.path + '.tmp'
+        with open(temp, 'wb') as f:
+            pickle.dump({'version': cache_version(), 'entries': self.used}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.path)
+
+    def release(self):
+        # after saving, when nothing is going to build with this cache again, the states would keep the text of every file alive
+        # the next get_parse_cache for this path loads it from disk again
+        self.entries = {}
+        self.used = {}
+        self.pending = {}
+        if parse_caches.get(self.path) is self:
+            del parse_caches[self.path]
+
+
+parse_caches = {}
+
+def get_parse_cache(path, definitions):
+    # keeps the cache in memory for as long as this module isn't reloaded, like in --watch mode
+    global parse_caches
+    cache = parse_caches.get(path)
+    if cache is None:
+        cache = ParseCache(path, definitions)
+        parse_caches[path] = cache
+    else:
+        cache.reset(definitions)
+    return cache
+
+
+def cache_version() -> str:
+    # any change to the code that reads files invalidates the cache
+    if not hasattr(cache_version, 'version'):
+        h = hashlib.md5()
+        folder = os.path.dirname(os.path.abspath(__file__))
+        for name in ('base.py', 'lexer.py', 'preprocessor.py', 'reader.py'):
+            with open(os.path.join(folder, name), 'rb') as f:
+                h.update(f.read())
+        cache_version.version = h.hexdigest()
+    return cache_version.version
+
+
+def proc_file(file, files, mod_name, injects, preprocessor, definitions, cache=None, entry=None, graph=None):
     debug("Processing "+file+" from "+mod_name)
-    if not exists(file):
-        return
-    if not is_uc_file(file):
-        f = OtherFile.ReadOtherFile(mod_name, file)
+    if entry is None:
+        if not exists(file):
+            return
+        uc = is_uc_file(file)
+    else:
+        uc = entry.uc
+    if not uc:
+        f = OtherFile.ReadOtherFile(mod_name, file, entry)
         if f is None:
             return
         files[file] = f
         return f
 
-    if not hasattr(proc_file,"last_folder"):
-        proc_file.last_folder=""
+    log_folder(file, mod_name)
+    with timing.span('read', file):
+        f = UnrealScriptFile.read_file(mod_name, file, preprocessor, definitions, cache, entry)
+    return add_file(f, files, injects, graph)
+
+
+def proc_files(entries, files, mod_name, injects, preprocessor, definitions, cache=None, pool=None, graph=None):
+    # takes a list of IndexEntry
+    # the unrealscript files get decoded and preprocessed in the pool, but they get added in the original order so the results are deterministic
+    ret = []
+    done = {}
+    if pool:
+        todo = []
+        for entry in entries:
+            if not entry.uc:
+                continue
+            if cache is not None:
+                hit, f = cache.load(entry.path, mod_name, entry)
+                if hit:
+                    done[entry.path] = f
+                    continue
+            todo.append(entry)
+        # the templates go back and forth so the next profile doesn't compile them again in its own reader processes
+        jobs = [(entry.path, entry.uc, mod_name, definitions, preprocessor.templates.get(entry.path)) for entry in todo]
+        for entry, (f, result, events, template) in zip(todo, pool.map(read_worker, jobs)):
+            timing.merge(events)
+            if template is not None:
+                preprocessor.templates[entry.path] = template
+            if cache is not None:
+                cache.store(f, result)
+            done[entry.path] = result
+
+    for entry in entries:
+        file = entry.path
+        try:
+            if file in done:
+                debug("Processing "+file+" from "+mod_name)
+                log_folder(file, mod_name)
+                f = add_file(done[file], files, injects, graph)
+            else:
+                f = proc_file(file, files, mod_name, injects, preprocessor, definitions, cache, entry, graph)
+        except Exception as e:
+            appendException(e, "error processing file: "+file)
+            raise
+        if f:
+            ret.append(f)
+    return ret
+
+
+def read_worker(job):
+    # runs inside the pool, also returns the empty shell when the preprocessor skips the file so the cache can remember definitions_used
+    # and the timing events, since the worker processes can't record into the build's Timings
+    # and the file's template when it had to be compiled here
+    file, uc, mod_name, definitions, template = job
+    preprocessor = importlib.import_module('compiler.preprocessor')
+    if template is not None:
+        preprocessor.templates[file] = template
+    self = UnrealScriptFile()
+    self.file = file
+    self.mod_name = mod_name
+    self.binary = False
+    try:
+        with timing.recording(timing.Timings()) as timings:
+            with timing.span('read', file):
+                ret = self._read_file(preprocessor, definitions, uc)
+        self.lexed = None # cheaper to redo than to send back
+        compiled = preprocessor.templates.get(file)
+        return self, ret, timings.events, (compiled if compiled is not template else None)
+    except Exception as e:
+        appendException(e, "error processing file: "+file)
+        raise
+
+
+class ReadPool():
+    # only starts the worker processes once there's something to read, so a warm parse cache doesn't pay for them
+    min_files = 32
+
+    def __init__(self, jobs, start_method=None):
+        if sys.platform == 'win32':
+            # ProcessPoolExecutor raises a ValueError for more than 61 workers on Windows
+            jobs = min(jobs, 61)
+        self.jobs = jobs
+        self.start_method = start_method
+        self.executor = None
+
+    def map(self, func, jobs):
+        if len(jobs) < self.min_files or self.jobs < 2:
+            return map(func, jobs)
+        if self.executor is None:
+            info("starting "+str(self.jobs)+" reader processes")
+            context = multiprocessing.get_context(self.start_method) if self.start_method else None
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.jobs, mp_context=context)
+        chunksize = max(1, len(jobs) // (self.jobs * 4))
+        return self.executor.map(func, jobs, chunksize=chunksize)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def log_folder(file, mod_name):
+    if not hasattr(log_folder,"last_folder"):
+        log_folder.last_folder=""
     folder = Path(file).parent
-    if folder != proc_file.last_folder:
+    if folder != log_folder.last_folder:
         info("Processing folder "+str(folder)[-50:]+" from "+mod_name)
-    proc_file.last_folder = folder
+    log_folder.last_folder = folder
 
-    f = UnrealScriptFile.read_file(mod_name, file, preprocessor, definitions)
+
+def add_file(f, files, injects, graph=None):
     if f is None:
         return
 
+    if graph is not None and f.classname is not None:
+        graph.add(f.classname, f.baseclass)
+
     if f.operator not in vanilla_inheritance_keywords:
         key = f.namespace+'.'+f.baseclass
         if key not in injects:
@@ -164,10 +502,58 @@ def proc_file(file, files, mod_name, injects, preprocessor, definitions):
     return f
 
 
-def GetSubclasses(baseclass: str) -> list:
-    global subclasses
-    ret = []
-    for c in subclasses.get(baseclass, []):
-        ret.append(c)
-        ret.extend(GetSubclasses(c))
-    return ret
+class ClassGraph():
+    # the parent/children edges of every vanilla and mod class read in this build, using the classlines as they were read
+    # the transitive queries are cached until another edge gets added
+    def __init__(self):
+        self.parents = {}
+        self.children = {}
+        self.descendants_cache = {}
+        self.ancestors_cache = {}
+
+    def add(self, classname, baseclass):
+        self.parents[classname] = baseclass
+        if baseclass is None:
+            return
+        children = self.children.setdefault(baseclass, [])
+        if classname not in children:
+            children.append(classname)
+        self.descendants_cache.clear()
+        self.ancestors_cache.clear()
+
+    def get_children(self, classname) -> list:
+        return list(self.children.get(classname, []))
+
+    def get_descendants(self, classname) -> list:
+        # depth first, each class only once
+        ret = self.descendants_cache.get(classname)
+        if ret is None:
+            ret = []
+            seen = {classname}
+            stack = list(reversed(self.children.get(classname, [])))
+            while stack:
+                c = stack.pop()
+                if c in seen:
+                    continue
+                seen.add(c)
+                ret.append(c)
+                stack.extend(reversed(self.children.get(c, [])))
+            self.descendants_cache[classname] = ret
+        return list(ret)
+
+    def get_ancestors(self, classname) -> list:
+        # closest parent first
+        ret = self.ancestors_cache.get(classname)
+        if ret is None:
+            ret = []
+            seen = {classname}
+            c = self.parents.get(classname)
+            while c is not None and c not in seen:
+                seen.add(c)
+                ret.append(c)
+                c = self.parents.get(c)
+            self.ancestors_cache[classname] = ret
+        return list(ret)
+
+    def is_subclass(self, classname, baseclass) -> bool:
+        return baseclass in self.get_ancestors(classname)
@@ -6,33 +6,52 @@ from compiler.base import *
 disabled = False
 whitelist = []
 
-def before_write(mod, f, injects):
+def before_write(mod, f, injects, children=None):
     global whitelist, disabled
     if disabled:
         return
+    if children is None:
+        children = index_children(mod)
 
     orig_base = f.baseclass
     info('starting shimming '+f.classline)
-    f.modify_classline(f.classname, 'extends', f.baseclass)
+    rebase(f, f.classname, 'extends', f.baseclass, children)
     debug(indent(f.classline))
     baseclass = f.classname
     for i in injects:
         if i != f:
-            i.modify_classline(i.classname, 'extends', baseclass)
+            rebase(i, i.classname, 'extends', baseclass, children)
             debug(indent(i.classline))
             baseclass = i.classname
 
     debug(indent('modifying children...'))
-    for t in mod.values():
-        if type(t).__name__ != 'UnrealScriptFile':
-            continue
-        if t in injects or t.baseclass != orig_base:
+    for t in list(children.get(orig_base, {}).values()):
+        if t in injects:
             continue
         debug(indent('shimming between '+t.classname+' and '+baseclass+' and '+orig_base))
-        t.modify_classline(t.classname, t.operator, baseclass)
+        rebase(t, t.classname, t.operator, baseclass, children)
     debug('done shimming')
 
 
+def index_children(mod):
+    # baseclass -> {id(file): file} for the unrealscript files in mod, so each shim only looks at its direct children
+    children = {}
+    for t in mod.values():
+        if type(t).__name__ != 'UnrealScriptFile':
+            continue
+        children.setdefault(t.baseclass, {})[id(t)] = t
+    return children
+
+
+def rebase(t, classname, operator, baseclass, children):
+    # modify_classline and keep the children index up to date for the next shims
+    old_base = t.baseclass
+    t.modify_classline(classname, operator, baseclass)
+    if old_base != t.baseclass and id(t) in children.get(old_base, {}):
+        del children[old_base][id(t)]
+        children.setdefault(t.baseclass, {})[id(t)] = t
+
+
 def execute_injections(f, prev, idx, inject, injects):
     return True
 
@@ -1,10 +1,12 @@
 # runs the automated tests using
 from compiler.base import *
+import compiler.timing as timing
+import hashlib
+import json
 
 
-def runAutomatedTests(out, package):
+def runAutomatedTests(out, package, fail_fast=False, timeout=600, force=False):
     rc = False
-    cleanup(out)
 
     if exists(out + '/System/Default.ini'):
         # copy Default.ini (defaults for DeusEx.ini) to test.ini, change [Engine.Engine] DefaultServerGame to =DeusEx.DXRandoTests
@@ -16,6 +18,17 @@ def runAutomatedTests(out, package):
             if "DefaultServerGame" in lines[i]:
                 lines[i] = "DefaultServerGame="+package+".DXRandoTests\n"
 
+        # the same compiled packages with the same test.ini will give the same results
+        cache = TestCache(out, package, lines)
+        if not force:
+            cached = cache.load()
+            if cached:
+                printHeader('Cached Test Results')
+                notice("the .u files haven't changed since the last test run, replaying its results, use --force-tests to run them again")
+                return cached.report()
+
+        cleanup(out)
+
         f = open(out + '/System/test.ini','w')
         f.writelines(lines)
         f.close()
@@ -28,7 +41,10 @@ def runAutomatedTests(out, package):
         cmd = [ out + '/System/UCC.exe', 'server', 'ini=test.ini' ]
         if os.name != 'nt':
             cmd = ['wine'] + cmd
-        log = call(cmd)[1]
+        # the results get parsed while the server is running, with fail_fast it gets stopped once we know how it went
+        results = TestResults(fail_fast)
+        with timing.span('ucc server'):
+            call(cmd, timeout=timeout, on_line=results.feed, tail=200)
         cleanup(out)
 
         printHeader('Automated Tests Finished')
@@ -38,7 +54,10 @@ def runAutomatedTests(out, package):
         printHeader('Results')
 
         if exists(out + '/System/UCC.log'):
-            rc = parseUCClog(log)
+            rc = results.report()
+            if not results.stopped:
+                # a run that fail_fast cut short didn't get to all of the tests
+                cache.save(results)
         else:
             print("Couldn't find UCC.log - did the compilation actually happen?")
             rc = False
@@ -51,69 +70,133 @@ def runAutomatedTests(out, package):
     return rc
 
 
+class TestCache():
+    # the results of the last test run, keyed by the hashes of the .u files, the test.ini and the test package
+    def __init__(self, out, package, ini_lines):
+        self.path = os.path.join(get_cache_dir(out), 'test_results.json')
+        h = hashlib.md5()
+        h.update(('package '+package+'\n').encode('utf-8'))
+        h.update(''.join(ini_lines).encode('utf-8'))
+        for file in sorted((Path(out)/'System').glob('*.u')):
+            with open(file, 'rb') as f:
+                h.update((file.name.lower()+' '+hashlib.md5(f.read()).hexdigest()+'\n').encode('utf-8'))
+        self.key = h.hexdigest()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            notice('ignoring unreadable test results '+self.path+': '+repr(e))
+            return None
+        if data.get('key') != self.key:
+            return None
+        return TestResults.from_state(data['results'])
+
+    def save(self, results):
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'key': self.key, 'results': results.get_state()}, f, indent=0)
+        os.replace(temp, self.path)
+
+
 def parseUCClog(log):
-    lines = log.splitlines()
-
-    modulesTested = []
-    failures = []
-    allTestsPassed = []
-    allExtendedTestsPassed = []
-    startingTests = []
-    warnings = []
-    #Run through to find modules that ran tests and what failures there were
-    for line in lines:
+    results = TestResults()
+    for line in log.splitlines():
+        results.feed(line)
+    return results.report()
+
+
+class TestResults():
+    # keeps the running counts while the UCC server's output streams in
+    def __init__(self, fail_fast=False):
+        self.fail_fast = fail_fast
+        self.stopped = False
+        self.modulesTested = []
+        self.failures = []
+        self.allTestsPassed = []
+        self.allExtendedTestsPassed = []
+        self.startingTests = []
+        self.warnings = []
+
+    def feed(self, line) -> bool:
+        # returns True when fail_fast is on and a test failed, so call() can stop the server
+        # a pass is only known once the server exits on its own, each module prints its own all tests passed! lines
         if "passed tests!" in line:
-            pass #modulesTested.append(line.strip())
+            pass #self.modulesTested.append(line.strip())
         elif "tests failed!" in line:
-            modulesTested.append(line.strip())
+            self.modulesTested.append(line.strip())
         elif line.startswith("ERROR: fail: "):
-            failures.append(line.strip())
+            self.failures.append(line.strip())
         elif "all tests passed!" in line:
-            allTestsPassed.append(line.strip())
+            self.allTestsPassed.append(line.strip())
         elif "all extended tests passed!" in line:
-            allExtendedTestsPassed.append(line.strip())
+            self.allExtendedTestsPassed.append(line.strip())
         elif "starting RunTests()" in line:
-            startingTests.append(line.strip())
+            self.startingTests.append(line.strip())
         elif "WARNING:" in line:
-            warnings.append(line.strip())
+            self.warnings.append(line.strip())
         elif "ERROR" in line:
-            warnings.append(line.strip())
+            self.warnings.append(line.strip())
         elif "Accessed None" in line:
-            warnings.append(line.strip())
+            self.warnings.append(line.strip())
         elif "Accessed array out of bounds" in line:
-            warnings.append(line.strip())
-
-    for module in modulesTested:
-        print(module)
-
-    print("")
+            self.warnings.append(line.strip())
+        else:
+            return False
+        if self.fail_fast and len(self.failures) > 0:
+            self.stopped = True
+        return self.stopped
+
+    def get_state(self) -> dict:
+        state = dict(self.__dict__)
+        del state['fail_fast']
+        del state['stopped']
+        return state
+
+    @staticmethod
+    def from_state(state):
+        self = TestResults()
+        self.__dict__.update(state)
+        return self
+
+    def passed(self) -> bool:
+        return len(self.allTestsPassed) == len(self.startingTests) and len(self.allTestsPassed) > 0 and len(self.startingTests) > 0 and len(self.allExtendedTestsPassed) > 0
+
+    def report(self) -> bool:
+        for module in self.modulesTested:
+            print(module)
 
-    if len(warnings) > 0:
-        print_colored("Test Warnings ("+str(len(warnings))+"):")
-        print("-----------------")
-        for warn in warnings:
-            print_colored(warn)
         print("")
 
-    if len(failures) > 0:
-        printError("Test Failures ("+str(len(failures))+"):")
-        printError("-----------------")
-        for fail in failures:
-            print_colored(fail)
-        print("")
-        rc = False
+        if len(self.warnings) > 0:
+            print_colored("Test Warnings ("+str(len(self.warnings))+"):")
+            print("-----------------")
+            for warn in self.warnings:
+                print_colored(warn)
+            print("")
+
+        if len(self.failures) > 0:
+            printError("Test Failures ("+str(len(self.failures))+"):")
+            printError("-----------------")
+            for fail in self.failures:
+                print_colored(fail)
+            print("")
+            rc = False
 
-    elif len(allTestsPassed) == len(startingTests) and len(allTestsPassed) > 0 and len(startingTests) > 0 and len(allExtendedTestsPassed) > 0:
-        print("All tests passed! len(startingTests) == "+str(len(startingTests))+", len(allTestsPassed) == "+str(len(allTestsPassed))+", len(allExtendedTestsPassed) == "+str(len(allExtendedTestsPassed)))
-        rc = True
-    else:
-        print("len(startingTests) == "+str(len(startingTests))+", len(allTestsPassed) == "+str(len(allTestsPassed))+", len(allExtendedTestsPassed) == "+str(len(allExtendedTestsPassed)))
-        printError("Failed to run tests!")
-        rc = False
+        elif self.passed():
+            print("All tests passed! len(startingTests) == "+str(len(self.startingTests))+", len(allTestsPassed) == "+str(len(self.allTestsPassed))+", len(allExtendedTestsPassed) == "+str(len(self.allExtendedTestsPassed)))
+            rc = True
+        else:
+            print("len(startingTests) == "+str(len(self.startingTests))+", len(allTestsPassed) == "+str(len(self.allTestsPassed))+", len(allExtendedTestsPassed) == "+str(len(self.allExtendedTestsPassed)))
+            printError("Failed to run tests!")
+            rc = False
 
-    print("")
-    print("")
-    return rc
+        print("")
+        print("")
+        return rc
 
 
 def cleanup(out):
@@ -0,0 +1,97 @@
+# spans for the phases of a build and the files inside of them
+# saved as a chrome trace event file (open it in ui.perfetto.dev) and printed as a summary with the slowest files
+from compiler.base import *
+import heapq
+import json
+
+# each thread records into its own Timings, so profiles building at the same time don't mix
+local = threading.local()
+
+
+class Timings():
+    def __init__(self, name=''):
+        self.name = name
+        self.start = time.perf_counter()
+        # (phase, file, start, end, pid, tid, depth), file is None for the phases
+        self.events = []
+
+    def add(self, phase, file, start, end, depth=0):
+        self.events.append((phase, file, start, end, os.getpid(), threading.get_ident(), depth))
+
+    def totals(self, top_level=False) -> dict:
+        # the file spans aren't counted, they're already inside of a phase
+        totals = {}
+        for (phase, file, start, end, pid, tid, depth) in self.events:
+            if file is None and (depth == 0 or not top_level):
+                totals[phase] = totals.get(phase, 0) + end - start
+        return totals
+
+    def slowest_files(self, n) -> dict:
+        files = {}
+        for (phase, file, start, end, pid, tid, depth) in self.events:
+            if file is not None:
+                files.setdefault(phase, []).append((end - start, file))
+        return {phase: heapq.nlargest(n, durations) for (phase, durations) in files.items()}
+
+    def save(self, path):
+        events = []
+        for (phase, file, start, end, pid, tid, depth) in self.events:
+            event = {'name': phase, 'cat': phase, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': round((start - self.start) * 1000000, 1), 'dur': round((end - start) * 1000000, 1)}
+            if file is not None:
+                event['name'] = os.path.basename(file)
+                event['args'] = {'file': file}
+            events.append(event)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'profile': self.name}}, f)
+        os.replace(tmp, path)
+
+    def print_summary(self, top=5):
+        printHeader("timings for "+self.name)
+        for (phase, total) in self.totals().items():
+            print('{:<24}{:>10.3f}s'.format(phase, total))
+        for (phase, durations) in self.slowest_files(top).items():
+            print("\nslowest files for "+phase+":")
+            for (duration, file) in durations:
+                print('{:>10.3f}s  {}'.format(duration, file))
+        print("")
+
+
+def current():
+    # so a thread that works for the build can record into its Timings
+    return getattr(local, 'timings', None)
+
+
+@contextmanager
+def recording(timings):
+    prev = (getattr(local, 'timings', None), getattr(local, 'depth', 0))
+    local.timings = timings
+    local.depth = 0
+    try:
+        yield timings
+    finally:
+        (local.timings, local.depth) = prev
+
+
+@contextmanager
+def span(phase, file=None):
+    timings = getattr(local, 'timings', None)
+    if timings is None:
+        yield
+        return
+    depth = local.depth
+    local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        local.depth = depth
+        timings.add(phase, file, start, time.perf_counter(), depth)
+
+
+def merge(events):
+    # for the events that came back from the reader processes
+    timings = getattr(local, 'timings', None)
+    if timings is not None and events:
+        timings.events.extend(events)
@@ -0,0 +1,143 @@
+# watches the source and mod folders for --watch mode, uses inotify on Linux and falls back to polling the file stats
+from compiler.base import *
+from abc import ABC, abstractmethod
+import ctypes
+import ctypes.util
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+inotify_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+inotify_event = struct.Struct('iIII')
+
+
+def make_watcher(paths, ignore=(), poll_interval=1.0):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths, ignore)
+        except Exception as e:
+            notice("inotify isn't available, polling instead: "+repr(e))
+    return PollingWatcher(paths, ignore, poll_interval)
+
+
+class Watcher(ABC):
+    def __init__(self, paths, ignore=()):
+        self.paths = [p for p in paths if os.path.exists(p)]
+        self.ignore = [os.path.abspath(i) for i in ignore]
+
+    def ignored(self, path) -> bool:
+        if os.path.basename(path).startswith('.'):
+            return True
+        path = os.path.abspath(path)
+        for i in self.ignore:
+            if path == i or path.startswith(i + os.sep):
+                return True
+        return False
+
+    def wait(self, debounce=0.5) -> set:
+        # blocks until something changes, then keeps collecting until it's been quiet for debounce seconds, editors tend to save in bursts
+        changed = set()
+        while not changed:
+            changed = self.poll(None)
+        while True:
+            more = self.poll(debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    @abstractmethod
+    def poll(self, timeout) -> set:
+        # returns the paths that changed, waiting up to timeout seconds for the first one, or forever if timeout is None
+        pass
+
+
+class InotifyWatcher(Watcher):
+    def __init__(self, paths, ignore=()):
+        super().__init__(paths, ignore)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.watches = {}
+        for path in self.paths:
+            if os.path.isdir(path):
+                self.add_tree(path)
+            else:
+                self.add_watch(os.path.dirname(path) or '.')
+        info("watching "+str(len(self.watches))+" folders with inotify")
+
+    def add_watch(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), inotify_mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for '+folder)
+        self.watches[wd] = folder
+
+    def add_tree(self, folder):
+        if self.ignored(folder):
+            return
+        self.add_watch(folder)
+        with os.scandir(folder) as it:
+            for e in it:
+                if e.is_dir() and not e.is_symlink():
+                    self.add_tree(os.path.join(folder, e.name))
+
+    def poll(self, timeout) -> set:
+        changed = set()
+        r, w, x = select.select([self.fd], [], [], timeout)
+        if not r:
+            return changed
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = inotify_event.unpack_from(data, pos)
+            pos += inotify_event.size
+            name = data[pos:pos+length].rstrip(b'\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                changed.update(self.paths)
+                continue
+            folder = self.watches.get(wd)
+            if folder is None:
+                continue
+            path = os.path.join(folder, os.fsdecode(name)) if name else folder
+            if self.ignored(path):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+            changed.add(path)
+        return changed
+
+
+class PollingWatcher(Watcher):
+    def __init__(self, paths, ignore=(), interval=1.0):
+        super().__init__(paths, ignore)
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+        info("polling "+str(len(self.snapshot))+" files for changes every "+str(interval)+" seconds")
+
+    def take_snapshot(self) -> dict:
+        snapshot = {}
+        for entry in FileIndex(*self.paths).entries():
+            if not self.ignored(entry.path):
+                snapshot[entry.path] = (entry.size, entry.mtime_ns)
+        return snapshot
+
+    def poll(self, timeout) -> set:
+        start = timer()
+        while True:
+            snapshot = self.take_snapshot()
+            changed = set(k for k in snapshot.keys() ^ self.snapshot.keys())
+            changed.update(k for k in snapshot.keys() & self.snapshot.keys() if snapshot[k] != self.snapshot[k])
+            self.snapshot = snapshot
+            if changed or (timeout is not None and timer() - start >= timeout):
+                return changed
+            time.sleep(self.interval if timeout is None else min(self.interval, timeout))
@@ -1,38 +1,52 @@
 # calls all of the inheritance operator modules (injects.py, shims.py, merges.py) and writes out the files
 # also cleans up the extra leftover files
 from compiler.base import *
+import filecmp
+import hashlib
 import importlib
+import json
 import pathlib
+import compiler.timing as timing
 
 modules = {}
+# profiles can build in threads, and they shouldn't import the same operator module at the same time
+modules_lock = threading.Lock()
 
 def load_module(name):
     global modules
     try:
-        if name not in modules and name in sys.modules:
-            modules[name] = importlib.reload(sys.modules[name])
-        if name not in modules:
-            modules[name] = importlib.import_module(name)
-        return modules[name]
+        with modules_lock:
+            if name not in modules and name in sys.modules:
+                modules[name] = importlib.reload(sys.modules[name])
+            if name not in modules:
+                modules[name] = importlib.import_module(name)
+            return modules[name]
     except Exception as e:
         print(traceback.format_exc())
         print('load_module('+name+')')
         raise
 
 def before_write(mod, injects):
+    # built once per pass instead of once per shim
+    children = None
     for i in injects:
         inject = injects[i]
         for f in inject:
-            before_write_file(mod, f, inject)
+            if f.operator in vanilla_inheritance_keywords:
+                continue
+            if children is None:
+                children = load_module('compiler.shims').index_children(mod)
+            before_write_file(mod, f, inject, children)
 
 
-def before_write_file(mod, f, injects):
+def before_write_file(mod, f, injects, children=None):
     if f.operator in vanilla_inheritance_keywords:
         return
 
     try:
         module = load_module( 'compiler.' + f.operator)
-        module.before_write(mod, f, injects)
+        with timing.span('before_write', f.file):
+            module.before_write(mod, f, injects, children)
     except Exception as e:
         print(traceback.format_exc())
         print('before_write_file('+repr(mod)+', '+f.file+') '+f.operator)
@@ -59,20 +73,31 @@ def execute_injections(f, injects):
 
     # loop through our parents and children
     prev = f
+    pending = None
     for idx, inject in enumerate(injects[f.qualifiedclass]):
         if f == inject or inject.operator in vanilla_inheritance_keywords:
             continue
         debug("execute_injections("+f.file+") "+inject.file+' '+inject.operator)
         try:
             module = load_module( 'compiler.' + inject.operator)
+            if pending is not None and pending is not module:
+                finish_injections(pending, f)
             write = module.execute_injections(f, prev, idx, inject, injects[f.qualifiedclass])
+            pending = module
             prev = inject
         except Exception as e:
             print(traceback.format_exc())
             print('execute_injections('+f.file+') '+inject.file+' '+inject.operator)
             raise
+    if pending is not None:
+        finish_injections(pending, f)
     return write
 
+def finish_injections(module, f):
+    # operators like merges batch up their work until a different operator or the write needs the content
+    if hasattr(module, 'finish_injections'):
+        module.finish_injections(f)
+
 def handle_inheritance_operator(f, injects):
     if f.operator in vanilla_inheritance_keywords:
         return True
@@ -86,9 +111,14 @@ def handle_inheritance_operator(f, injects):
         print('handle_inheritance_operator('+f.file+') '+f.operator)
         raise
 
-def write_file(out, f, written, injects):
+def write_file(out, f, written, injects, manifest=None, index=None):
     if f.file in written:
         return
+    with timing.span('write', f.file):
+        _write_file(out, f, written, injects, manifest, index)
+
+
+def _write_file(out, f, written, injects, manifest=None, index=None):
 
     if not hasattr(write_file,"last_folder"):
         write_file.last_folder=""
@@ -118,39 +148,167 @@ def write_file(out, f, written, injects):
     else:
         path = path / f.filename
 
-    if not exists_dir(parentPath):
-        os.makedirs(parentPath, exist_ok=True)
+    if index is None or not index.has_dir(parentPath):
+        if not exists_dir(parentPath):
+            os.makedirs(parentPath, exist_ok=True)
+        if index is not None:
+            index.dirs.add(str(parentPath))
 
+    # like a vanilla class that a mod overrides, the stats in the index and manifest are from before this build so they can't be trusted
+    rewrite = str(path) in written
     written[f.file] = 1
     written[str(path)] = 1
 
-    if exists(path):
-        oldcontent = None
-        if f.binary:
-            with open(path, 'rb') as file:
-                oldcontent = file.read()
-        else:
-            with open(path, 'r', encoding='windows-1252') as file:
-                oldcontent = file.read()
-        if oldcontent == f.content:
-            return
+    if f.binary:
+        write_binary(f, path, manifest, index, rewrite)
+        return
+
+    # UCC wants windows-1252, and we write bytes so the hash matches exactly what's on disk
+    data = f.content.replace('\n', os.linesep).encode('windows-1252', 'replace')
+    hash = hashlib.md5(data).hexdigest()
+
+    if not rewrite and manifest is not None and manifest.unchanged(str(path), hash):
+        manifest.record(str(path), hash, False)
+        return
+    if index is not None:
+        existed = index.get(path) is not None
+    else:
+        existed = exists(path)
+    if not rewrite and (manifest is None or not manifest.known(str(path))) and existed:
+        # not in the manifest yet, fall back to comparing the contents
+        with open(path, 'rb') as file:
+            if file.read() == data:
+                if manifest is not None:
+                    manifest.record(str(path), hash, False)
+                return
 
     debug("writing from: "+f.file+" to: "+str(path))
     debug("")
-    if f.binary:
-        with open(path, 'wb') as file:
-            file.write(f.content)
+    with open(path, 'wb') as file:
+        file.write(data)
+    if manifest is not None:
+        manifest.record(str(path), hash)
+
+
+def write_binary(f, path, manifest=None, index=None, rewrite=False):
+    # the manifest remembers the source file's stats instead of a hash, so an unchanged sound or texture never gets read
+    hash = 'stat:'+str(f.size)+':'+str(f.mtime_ns)
+    if not rewrite and manifest is not None and manifest.unchanged(str(path), hash):
+        manifest.record(str(path), hash, False)
+        return
+    if index is not None:
+        existing = index.get(path)
+        existing_size = existing.size if existing else None
     else:
-        with open(path, 'w') as file:
-            file.write(f.content)
+        existing_size = os.path.getsize(path) if exists(path) else None
+    if not rewrite and (manifest is None or not manifest.known(str(path))) and existing_size == f.size:
+        # not in the manifest yet, fall back to comparing the contents in chunks
+        if filecmp.cmp(f.file, path, shallow=False):
+            if manifest is not None:
+                manifest.record(str(path), hash, False)
+            return
+
+    debug("copying from: "+f.file+" to: "+str(path))
+    copy_file(f.file, path)
+    if manifest is not None:
+        manifest.record(str(path), hash)
+
 
-def cleanup(out, written):
-    for file in insensitive_glob(out+'*'):
-        if not is_uc_file(file):# TODO: cleanup text files...
+class Manifest():
+    # remembers the hash, size and mtime of every file we wrote to the out_dir
+    # so on the next build unchanged files can be skipped without reading them back
+    # keyed by the path relative to the out_dir, so spelling the out_dir differently doesn't make every file look stale
+    def __init__(self, out, index=None):
+        self.path = os.path.join(get_cache_dir(out), 'manifest.json')
+        self.out = out
+        self.prefix = str(pathlib.PurePath(out)) + os.sep
+        self.index = index
+        self.old = {}
+        self.new = {}
+        self.loaded = False
+        try:
+            with open(self.path) as f:
+                # older manifests had the full paths
+                self.old = {(self.key(k) if os.path.isabs(k) else k): v for (k, v) in json.load(f).items()}
+            self.loaded = True
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            notice('ignoring unreadable manifest '+self.path+': '+repr(e))
+
+    def key(self, path) -> str:
+        # the paths from write_file start with the out_dir spelled the same way, relpath is only needed for the others
+        if path.startswith(self.prefix):
+            return path[len(self.prefix):].replace(os.sep, '/')
+        return Path(os.path.relpath(path, self.out)).as_posix()
+
+    def known(self, path) -> bool:
+        return self.key(path) in self.old
+
+    def unchanged(self, path, hash):
+        entry = self.old.get(self.key(path))
+        if entry is None or entry[0] != hash:
+            return False
+        if self.index is not None:
+            st = self.index.get(path)
+            if st is None:
+                return False
+            size, mtime_ns = st.size, st.mtime_ns
+        else:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return False
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        # if someone else touched the file then we rewrite it
+        return size == entry[1] and mtime_ns == entry[2]
+
+    def record(self, path, hash, written=True):
+        if not written and self.index is not None and self.index.get(path) is not None:
+            st = self.index.get(path)
+            self.new[self.key(path)] = [hash, st.size, st.mtime_ns]
+            return
+        st = os.stat(path)
+        self.new[self.key(path)] = [hash, st.st_size, st.st_mtime_ns]
+
+    def save(self, keep_old=False):
+        # keep_old is for builds that stopped before cleanup, the files from last time are still there
+        # without a manifest from last time the next build has to look through the whole out_dir anyway
+        entries = self.new
+        if keep_old and not self.loaded:
+            return
+        if keep_old:
+            entries = dict(self.old)
+            entries.update(self.new)
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(entries, f, indent=0, sort_keys=True)
+        os.replace(temp, self.path)
+
+
+def cleanup(out, written, manifest=None):
+    if manifest is None or not manifest.loaded:
+        # first build with a manifest, so we need to look through the whole out_dir
+        cleanup_all(out, written)
+        return
+    # anything we wrote last time but not this time is stale, this includes text files and binary files
+    # written also has the source paths, only the ones in out_dir can match
+    written = set(manifest.key(p) for p in written if p.startswith(manifest.prefix))
+    for key in sorted(manifest.old.keys() - manifest.new.keys()):
+        if key in written:
             continue
-        path = pathlib.PurePath(file)
+        file = os.path.join(out, key)
+        if exists(file):
+            print("cleaning up "+file)
+            os.remove(file)
+
+
+def cleanup_all(out, written):
+    for entry in FileIndex(out+'*').entries():
+        if not entry.uc:
+            continue
+        path = pathlib.PurePath(entry.path)
         if str(path) in written:
             continue
         print("cleaning up "+str(path))
         os.remove(path)
-